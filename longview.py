@@ -34,16 +34,25 @@ from __future__ import absolute_import, division, with_statement
 
 import csv
 import datetime
+import marshal
 import math
 import os
+import re
 import shutil
 import sys
+import textwrap
+import zlib
 
+from array import array
+from bisect import bisect_left, bisect_right
+from cStringIO import StringIO
 from optparse import OptionParser
 from tempfile import mkdtemp
 
 import lvhtml
 import lvnotify
+import lvpng
+import lvraster
 import lvutils
 import sliceMaker
 
@@ -89,6 +98,118 @@ timelineSections = []
 # assumed to be ordered
 navcells = []
 
+# lookup tables indexed by (month - monthTableStart), filled in by
+# buildMonthTables(): the starting X pixel of each month, its width in
+# pixels, and the index into timelineSections of the section containing it
+# (-1 if there isn't one)
+monthTableStart = 0
+monthXCoords = array('l')
+monthWidths = array('l')
+monthSections = array('l')
+
+# sorted start and end dates of the top and bottom halves of the rows, built
+# on demand by getNavCellLocation()
+navRowIndex = None
+
+# process pool that bar images are rendered in, if any, and the results of
+# the renders it hasn't finished yet
+barImagePool = None
+pendingBarImages = []
+
+# lvutils.ImageCache that bar images are reused from, if any
+barImageCache = None
+
+# lvutils.BuildState of an incremental build, if this is one
+buildState = None
+
+# (date, anchor name, label) of every date in the date tables; see
+# buildDateLabels()
+dateLabels = None
+
+# escape sequences in popup templates, and the templates split up on them by
+# compilePopupTemplate(), keyed by template text
+popupEscapeRE = re.compile(r"%([dnt1-9])")
+popupTemplates = {}
+
+# write the popups into script files timeline.js loads when they're first
+# shown, rather than into timeline.html?  See writePopupShards().
+lazyPopups = False
+popupsPerShard = 200
+
+# write the rows of the timeline into rows.js for timeline.js to put into the
+# page as they scroll into view, rather than into timeline.html?
+virtualRows = False
+
+# the pages the timeline is split into, if it is: dictionaries of the first
+# and last month each covers and the suffix of its file names (see
+# buildTimelinePages())
+timelinePages = None
+
+# filenames of the bar images already written, so that a row on more than one
+# page of a split timeline only gets its image drawn once
+writtenBarImages = {}
+
+# draw bar images as inline SVG instead of PNGs?
+svgBars = False
+
+# draw the timeline background as small tiles composed by the stylesheet,
+# rather than one image as wide as the timeline?
+tiledBackground = False
+
+# parsed parameters and "now" geometry; see buildRenderContext()
+renderContext = None
+
+class RenderContext:
+    """Read-only bundle of the parsed parameters used while rendering.
+
+    Built once by buildRenderContext(), after the timeline sections have
+    been laid out, so that rendering code doesn't keep reparsing params and
+    recomputing the now bar.  Attributes:
+
+    leftMargin, intervalSize, minBarWidth, resolutionInMonths -- ints from
+        the corresponding TIMELINE.* parameters
+    topFrameHeight -- TIMELINE.topframeheight as given, since the frameset
+        takes any height, such as "20%"
+    barHeight -- int height of timeline bars (see getbarheight())
+    diamondWidth, diamondLeftMargin, diamondVerticalMargin -- ints from
+        the corresponding EVENTBAR.* parameters
+    saturation -- float from EVENTBAR.saturation
+    nowBarOnTop -- bool from EVENTBAR.nowbarontop, or False
+    nowDate -- LVDate of now (see getnowdate())
+    nowBarStartXCoord -- int X coordinate where the now bar starts
+    nowBarWidth -- int width of the now bar as rendered
+    nowBarVirtualWidth -- float width of the now bar for calculations
+    futureStartXCoord -- int X coordinate of the first pixel of the future
+
+    Parameters that are only needed for some timelines, such as the diamond
+    ones, are None if they weren't given.  Use require() to read those, so
+    that a missing one raises KeyError, just as reading params would.
+    """
+
+    def __init__(self, missingParams, **fields):
+        """Initialize a RenderContext object
+
+        missingParams -- the names of the parameters that weren't given,
+                         keyed by the attribute they would have set
+        fields -- the attributes
+        """
+
+        self.__dict__['missingParams'] = missingParams
+        self.__dict__.update(fields)
+        return
+
+    def __setattr__(self, name, value):
+        raise AttributeError, "RenderContext attributes are read-only"
+
+    def require(self, name):
+        """Return an attribute, raising KeyError for its parameter if that
+        wasn't given.
+        """
+
+        if self.missingParams.has_key(name):
+            raise KeyError, self.missingParams[name]
+        return getattr(self, name)
+
 # a dictionary of dictionaries of dictionaries
 interestData = {}
 
@@ -107,6 +228,104 @@ def loadhooks(filename):
     return
 
 
+def reuseOutput(name, outputDir, dependencies):
+    """Copy a file from the previous build if nothing it depends on changed.
+
+    name -- file name, relative to the output directory
+    outputDir -- toplevel dir where output is being generated
+    dependencies -- anything with a repr() describing what name depends on
+
+    Returns True if the file was copied, or False if it needs to be
+    generated (always the case unless this is an incremental build).
+    """
+
+    if buildState is None:
+        return False
+
+    return buildState.reuse(name, outputDir, dependencies)
+
+
+def describeRow(row):
+    """Return everything that the HTML and images for a row depend on.
+
+    row -- dictionary of the properties of this row
+    """
+
+    subitems = [(int(subitem['date']), subitem['link'], subitem['args'],
+                 subitem.has_key('isNotification'))
+                for subitem in row['subitems']]
+
+    interest = interestData.get(row['nodeId'], {}).items()
+    interest.sort()
+
+    return (row['nodeId'], int(row['startDate']), int(row['endDate']),
+            row['endDate'].ongoing, row['link'],
+            row['title'], row['args'], subitems, interest)
+
+
+def describeTemplateSymbols(*names):
+    """Return the current values of the named lvhtml symbols.
+
+    Functions are described by describeTemplateFunction(), since the
+    template file is free to replace them, and symbols that aren't defined
+    as None.
+    """
+
+    description = []
+    for name in names:
+        value = getattr(lvhtml, name, None)
+        if hasattr(value, 'func_code'):
+            value = describeTemplateFunction(value, {})
+        description.append((name, value))
+
+    return description
+
+
+def describeTemplateFunction(function, described):
+    """Return everything the output of a template function depends on.
+
+    function -- the function to describe
+    described -- functions already being described, so that ones calling
+                 each other are only described once
+
+    That is its compiled code, its default argument values, and the values
+    of the module globals it uses, any of which the template file can change.
+    """
+
+    if described.has_key(function):
+        return function.__name__
+    described[function] = True
+
+    # collect the global names used by the function and any functions or
+    # lambdas defined in it
+    names = {}
+    codes = [function.func_code]
+    while len(codes) > 0:
+        code = codes.pop()
+        for name in code.co_names:
+            names[name] = True
+        codes.extend([const for const in code.co_consts
+                      if type(const) is type(code)])
+    names = names.keys()
+    names.sort()
+
+    globalValues = []
+    for name in names:
+        if not function.func_globals.has_key(name):
+            continue
+        value = function.func_globals[name]
+        if hasattr(value, 'func_code'):
+            value = describeTemplateFunction(value, described)
+        elif type(value) is type(lvhtml):
+            value = value.__name__
+        elif type(value) is type(popupEscapeRE):
+            value = (value.pattern, value.flags)
+        globalValues.append((name, value))
+
+    return (marshal.dumps(function.func_code), function.func_defaults,
+            globalValues)
+
+
 def writeNowNavCells(outputDir):
     """Write out the PNGs for the "now" navcell.
 
@@ -114,32 +333,41 @@ def writeNowNavCells(outputDir):
     """
 
     # what horizontal pixel in the timeline does "now" start at?
-    nowTimelineXCoord = getNowBarStartXCoord()
+    nowTimelineXCoord = renderContext.nowBarStartXCoord
 
     # let's get this as a percent of the area represented by the navcell
     startPixelAsPercentage = (
-        (nowTimelineXCoord - int(params['TIMELINE.leftmargin'])) %
+        (nowTimelineXCoord - renderContext.leftMargin) %
         pixelsPerNavCell) / pixelsPerNavCell
 
     # which pixel in the navcell will this be?
     navCellNowStart = int(math.floor(startPixelAsPercentage * navCellWidth))
 
     # draw the "onmouseover" cell
-    navCellOn = lvutils.NowCellPNG(
-        os.path.join(outputDir, "img-generated", "nav-now-on.png"), True,
-        navCellNowStart)
-    navCellOn.generate()
+    if not reuseOutput("img-generated/nav-now-on.png", outputDir,
+                       (True, navCellNowStart)):
+        navCellOn = lvutils.NowCellPNG(
+            os.path.join(outputDir, "img-generated", "nav-now-on.png"), True,
+            navCellNowStart)
+        navCellOn.generate()
 
     # draw the "onmouseout" cell
-    navCellOff = lvutils.NowCellPNG(
-        os.path.join(outputDir, "img-generated", "nav-now-off.png"), False,
-        navCellNowStart)
-    navCellOff.generate()
+    if not reuseOutput("img-generated/nav-now-off.png", outputDir,
+                       (False, navCellNowStart)):
+        navCellOff = lvutils.NowCellPNG(
+            os.path.join(outputDir, "img-generated", "nav-now-off.png"),
+            False, navCellNowStart)
+        navCellOff.generate()
     
     return
 
 
-def writePopups(outfileObject, rows):
+def listPopups(rows):
+    """Generate the popups of these rows and their subitems.
+
+    Each popup is a (template, nodeId, dateString, title, args) tuple of
+    the arguments to buildPopup() for it.
+    """
 
     for row in rows:
 
@@ -152,9 +380,8 @@ def writePopups(outfileObject, rows):
             dates = row['startDate'].toString(True, True) + " - " + \
                     row['endDate'].toString(True,True)
 
-        outfileObject.write(
-            buildPopup(lvhtml.popupTemplate, row['nodeId'], dates,
-                       row['title'], row['args']))
+        yield (lvhtml.popupTemplate, row['nodeId'], dates, row['title'],
+               row['args'])
 
         # if we have subitems, write out the popups for them
         subitemLetter = 97 # 'a'
@@ -165,15 +392,139 @@ def writePopups(outfileObject, rows):
             else:
                 template = lvhtml.popupTemplate
                 
-            outfileObject.write(
-                buildPopup(template, row['nodeId'] + chr(subitemLetter),
-                           subitem['date'].toString(True, True),
-                           row['title'], subitem['args']))
+            yield (template, row['nodeId'] + chr(subitemLetter),
+                   subitem['date'].toString(True, True), row['title'],
+                   subitem['args'])
             subitemLetter += 1
-                                         
+
+
+def generatePopups(rows):
+    """Generate the HTML for the popups of these rows and their subitems."""
+
+    for popup in listPopups(rows):
+        yield buildPopup(*popup)
+
+
+def writePopups(outfileObject, rows):
+    """Write out the popups of these rows and their subitems.
+
+    outfileObject -- file object to write to
+    rows -- rows to write the popups of
+    """
+
+    outfileObject.writelines(generatePopups(rows))
     return
 
 
+def quoteJavaScript(text):
+    """Return text as a JavaScript string literal.
+
+    Characters other than the ones that need escaping are left as they are,
+    so the browser reads them the same way as it would in the page itself.
+    "</" is escaped too, so the literal can't end an inline script.
+    """
+
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"') \
+           .replace('\n', '\\n').replace('\r', '\\r').replace('</', '<\\/')
+
+
+def writePopupShards(rows, outputDir, suffix=""):
+    """Write the popups for these rows into script files to load on demand
+
+    rows -- rows to write the popups of
+    outputDir -- directory to create the popups directory in
+    suffix -- to tell the shards of this page from those of other pages
+
+    The popups of consecutive rows are grouped into shards of about
+    popupsPerShard popups each, written to popups/<shard>.js as a call to
+    loadPopups() in timeline.js.  Each popup is stored as the index of its
+    template followed by the values of its escape sequences, for timeline.js
+    to fill in the first time the popup is shown.
+
+    Returns the script for timeline.html that gives timeline.js the
+    templates and the shard each node's popup is in.
+    """
+
+    templates = []
+    shards = []
+    shardIndex = []
+
+    for row in rows:
+
+        # keep a row and its subitems in the same shard
+        if len(shards) == 0 or len(shards[-1]) >= popupsPerShard:
+            shards.append([])
+
+        for template, nodeId, dateString, title, args in listPopups([row]):
+
+            if template not in templates:
+                templates.append(template)
+
+            values = getPopupValues(nodeId, dateString, title, args)
+            popup = [str(templates.index(template))]
+            for key in "dnt123456789"[:3 + len(args[:9])]:
+                popup.append(quoteJavaScript(values[key]))
+
+            shards[-1].append("%s:[%s]" % (quoteJavaScript(nodeId),
+                                           ",".join(popup)))
+            shardIndex.append("%s:%s" % (
+                quoteJavaScript(nodeId),
+                quoteJavaScript("%d%s" % (len(shards) - 1, suffix))))
+
+    if not os.path.isdir(os.path.join(outputDir, "popups")):
+        os.mkdir(os.path.join(outputDir, "popups"))
+    shardNum = 0
+    for shard in shards:
+        shardFile = open(os.path.join(outputDir, "popups",
+                                      "%d%s.js" % (shardNum, suffix)), "wt")
+        shardFile.write("loadPopups({%s});\n" % ",\n".join(shard))
+        shardFile.close()
+        shardNum += 1
+
+    compiledTemplates = []
+    for template in templates:
+        compiledTemplates.append("[%s]" % ",".join(
+            [quoteJavaScript(segment)
+             for segment in compilePopupTemplate(template)]))
+
+    return lvhtml.lazyPopupScript % ("[%s]" % ",\n".join(compiledTemplates),
+                                     "{%s}" % ",".join(shardIndex))
+
+
+def compilePopupTemplate(template):
+    """Split a popup template up on its escape sequences.
+
+    template -- HTML template to use for the popup
+
+    Returns a list alternating between literal HTML and the character after
+    the % of an escape sequence, starting and ending with literal HTML.
+    Templates are only split once, however many popups use them.
+    """
+
+    segments = popupTemplates.get(template)
+    if segments is None:
+        segments = popupEscapeRE.split(template.replace("\\n", "\n"))
+        popupTemplates[template] = segments
+
+    return segments
+
+
+def getPopupValues(nodeId, dateString, title, args):
+    """Return the values of a popup's escape sequences, keyed by the
+    character after the %.  The arguments are as for buildPopup().
+    """
+
+    values = {'d': dateString, 'n': str(nodeId), 't': title}
+
+    # only %1 through %9 exist
+    argNum = 1
+    for arg in args[:9]:
+        values[str(argNum)] = textwrap.fill(arg, 71)
+        argNum += 1
+
+    return values
+
+
 def buildPopup(template, nodeId, dateString, title, args):
     """Interpolate relevant values into the popup HTML.
 
@@ -183,35 +534,37 @@ def buildPopup(template, nodeId, dateString, title, args):
     args -- any additional values from data file to be interpolated
     """
 
-    import textwrap
-    import re
-    
-    popupHtml = re.sub(r'\\n', "\n", template)
-    popupHtml = re.sub("%d", dateString, popupHtml)
-    popupHtml = re.sub("%n", str(nodeId), popupHtml)
-    popupHtml = re.sub("%t", title, popupHtml)
-    
-    argNum = 1
-    for arg in args:
-        popupHtml = re.sub("%" + str(argNum), textwrap.fill(arg, 71), 
-                           popupHtml)
-        argNum += 1
+    values = getPopupValues(nodeId, dateString, title, args)
 
-    return popupHtml
+    popupHtml = compilePopupTemplate(template)[:]
+    for i in range(1, len(popupHtml), 2):
+        # arguments the row doesn't have are left as they are
+        popupHtml[i] = values.get(popupHtml[i], "%" + popupHtml[i])
 
+    return "".join(popupHtml)
 
-def writeLabels(outfileObject, rows):
 
-    outfileObject.write("""<div id="labels">
+def generateLabels(rows):
+    """Generate the HTML for the labels of these rows."""
+
+    yield """<div id="labels">
 <table class="labelstable" cellpadding="0" cellspacing="0" border="0">
-""")
+"""
 
     for row in rows:
-        outfileObject.write(
-            lvhtml.buildLabel(row['nodeId'], row['title'], row['link']))
+        yield lvhtml.buildLabel(row['nodeId'], row['title'], row['link'])
 
-    outfileObject.write("</table>\n</div>\n\n")
-    
+    yield "</table>\n</div>\n\n"
+
+
+def writeLabels(outfileObject, rows):
+    """Write out the labels of these rows.
+
+    outfileObject -- file object to write to
+    rows -- rows to write the labels of
+    """
+
+    outfileObject.writelines(generateLabels(rows))
     return
 
 
@@ -242,34 +595,49 @@ def generateNavCellList():
     pixelsPerNavCell = math.floor(totalWidth / numNavCells)
 
     # start at the left margin
-    nextIdealStartPoint = int(params['TIMELINE.leftmargin'])
+    nextIdealStartPoint = renderContext.leftMargin
 
     # iterate through the timeline sections
     for section in timelineSections:
 
-        # iterate through all the anchors
-        date = section['startDate']
-        while date <= section['endDate']:
-
-            # if this is the appropriate anchor (ie it's the closest
-            # anchor to the right of (or at) the ideal pixel)...
-            if getStartXCoordFromDate(date) >= nextIdealStartPoint:
-
-                # generate navcell with this anchor (we'll modify the
-                # 'now' cell later)
-                navcells.append({'date': lvutils.LVDate(date),
-                                 'now': False})
-
-                # bump up nextIdealStartPoint
-                nextIdealStartPoint = nextIdealStartPoint + pixelsPerNavCell
-                
-            # prepare for the next iteration
-            date = date + section['interval']
+        # anchors are evenly spaced within a section, and their X coordinates
+        # only ever increase, so rather than visiting every anchor we can
+        # binary search for the appropriate one (ie the closest anchor to the
+        # right of (or at) the ideal pixel)
+        anchor = 0
+        numAnchors = getNumAnchors(section)
+        startDate = int(section['startDate'])
+        interval = int(section['interval'])
+        while anchor < numAnchors:
+
+            low = anchor
+            high = numAnchors
+            while low < high:
+                middle = (low + high) // 2
+                if getStartXCoordFromDate(startDate + middle * interval) \
+                       >= nextIdealStartPoint:
+                    high = middle
+                else:
+                    low = middle + 1
+
+            # no more appropriate anchors in this section
+            if low == numAnchors:
+                break
+
+            # generate navcell with this anchor (we'll modify the 'now' cell
+            # later)
+            navcells.append(
+                {'date': lvutils.LVDate(startDate + low * interval),
+                 'now': False})
+
+            # bump up nextIdealStartPoint, and prepare for the next iteration
+            nextIdealStartPoint = nextIdealStartPoint + pixelsPerNavCell
+            anchor = low + 1
     
     # mark the "now" cell as such
     i = numNavCells - 1
     while i >= 0:
-        if getnowdate() >= navcells[i]['date']:
+        if renderContext.nowDate >= navcells[i]['date']:
             navcells[i]['now'] = True
             break
         i -= 1
@@ -280,25 +648,82 @@ def generateNavCellList():
         if i == len(navcells) - 1:
             end = timelineSections[-1]['endDate']
         else:
-            end = navcells[i+1]['date'] \
-                  - int(params['TIMELINE.resolutioninmonths'])
+            end = navcells[i+1]['date'] - renderContext.resolutionInMonths
 
         navcells[i]['location'] = getNavCellLocation(navcells[i]['date'], end)
 
-    # figure out the last date anchor
-    for section in timelineSections:
-        date = section['startDate']
-        while date <= section['endDate']:
-            date = date + section['interval']
-
     # because of the way anchors work (they only guarantee that the anchor in
     # question will be on screen) we really want the last navcell to
-    # point to the far right of the timeline.
-    navcells[numNavCells-1]['date'] = date - section['interval']
+    # point to the far right of the timeline, ie the last date anchor.
+    section = timelineSections[-1]
+    navcells[numNavCells-1]['date'] = section['startDate'] \
+        + (getNumAnchors(section) - 1) * section['interval']
 
     return
 
 
+def getNumAnchors(section):
+    """Return the number of date anchors in the given timeline section."""
+
+    return max((section['endDate'] - section['startDate'])
+               // section['interval'] + 1, 0)
+
+
+def buildNavRowIndex():
+    """Return an index of the rows for counting visible bars quickly.
+
+    The index is a (top, bottom) pair, one for each half of the rows as
+    split by getNavCellLocation().  Each half is a tuple of the sorted start
+    dates and sorted end dates of its rows, a list of any rows which end
+    before they start (and so have to be checked one by one), and the list
+    of all its rows.
+    """
+
+    lastTopRow = int(math.floor(len(rows) / 2))
+
+    index = []
+    for half in (rows[0:lastTopRow], rows[lastTopRow+1:]):
+        startDates = [row['startDate'] for row in half
+                      if row['startDate'] <= row['endDate']]
+        endDates = [row['endDate'] for row in half
+                    if row['startDate'] <= row['endDate']]
+        startDates.sort()
+        endDates.sort()
+        backwardsRows = [row for row in half
+                         if row['startDate'] > row['endDate']]
+        index.append((startDates, endDates, backwardsRows, half))
+
+    return tuple(index)
+
+
+def countVisibleRows(halfIndex, startDate, endDate):
+    """Return how many rows in half of a navRowIndex intersect the given span.
+
+    A row intersects if it starts before endDate and ends after startDate.
+    """
+
+    startDates, endDates, backwardsRows, halfRows = halfIndex
+
+    # for an empty span, the sorted lists don't help; this is rare enough
+    # that we just check every row
+    if startDate >= endDate:
+        rowsToCheck = halfRows
+        visible = 0
+
+    # otherwise a row that starts at or after endDate can't also end at or
+    # before startDate, so every row which does neither is visible
+    else:
+        rowsToCheck = backwardsRows
+        visible = bisect_left(startDates, endDate) \
+                  - bisect_right(endDates, startDate)
+
+    for row in rowsToCheck:
+        if row['startDate'] < endDate and row['endDate'] > startDate:
+            visible += 1
+
+    return visible
+
+
 def getNavCellLocation(startDate, endDate):
     """Returns location ("top" or "bottom") for a given navcell to point to.
 
@@ -309,20 +734,14 @@ def getNavCellLocation(startDate, endDate):
     endDate -- LVDate of the end date
     """
 
-    lastTopRow = int(math.floor(len(rows) / 2))
+    global navRowIndex
+    if navRowIndex is None:
+        navRowIndex = buildNavRowIndex()
 
-    # iterate through top timeline bars to count how many intersect with the
-    # timespan of this navcell
-    topRowsVisible = 0
-    for i in range(0, lastTopRow):
-        if rows[i]['startDate'] < endDate and rows[i]['endDate'] > startDate:
-            topRowsVisible += 1
-
-    # iterate through bottom timeline bars
-    bottomRowsVisible = 0
-    for i in range(lastTopRow+1, len(rows)):
-        if rows[i]['startDate'] < endDate and rows[i]['endDate'] > startDate:
-            bottomRowsVisible += 1
+    # count how many timeline bars in each half intersect with the timespan
+    # of this navcell
+    topRowsVisible = countVisibleRows(navRowIndex[0], startDate, endDate)
+    bottomRowsVisible = countVisibleRows(navRowIndex[1], startDate, endDate)
     
     # return whichever half has more
     if topRowsVisible >= bottomRowsVisible:
@@ -331,40 +750,164 @@ def getNavCellLocation(startDate, endDate):
         return "bottom"
 
 
-def writeDateTable(outfileObject, tableClass, namePrefix):
+def buildDateLabels():
+    """Return the (date, anchor name, label) of every date in the date tables.
+    """
+
+    labels = []
+    for section in timelineSections:
+
+        # all the labels in this section
+        date = int(section['startDate'])
+        endDate = int(section['endDate'])
+        interval = int(section['interval'])
+        while date <= endDate:
+            labels.append((date,
+                           lvutils.formatDate(date, monthSeparator="_"),
+                           lvutils.formatDate(date, monthSeparator="/")))
+            date += interval
+
+    return labels
+
+
+def buildDateTable(tableClass, namePrefix, dateRange=None):
+    """Return the HTML for a row of date labels across the timeline.
+
+    tableClass -- CSS class of the table
+    namePrefix -- prefix for the anchor names of the dates
+    dateRange -- (first month, last month) of the dates to label, if not all
+                 of them; the rest are left blank
+    """
+
+    global dateLabels
+    if dateLabels is None:
+        dateLabels = buildDateLabels()
+
+    blankCell = """<td class="ycell">
+<img src="img-static/no.gif" width="%d" height="1" alt="" border="0" /></td>\n
+"""
+
+    cells = []
+    blankCells = 0
+    for date, name, label in dateLabels:
+
+        if dateRange is not None and \
+           (date < dateRange[0] or date > dateRange[1]):
+            blankCells += 1
+            continue
+
+        # one cell as wide as all the unlabeled dates before this one
+        if blankCells > 0:
+            cells.append(blankCell % (blankCells * renderContext.intervalSize))
+            blankCells = 0
+
+        cells.append("""<td class="ycell">
+<a name="%s%s">%s</a><br />
+<img src="img-static/no.gif" width="%d" height="1" alt="" border="0" /></td>\n
+""" % (namePrefix, name, label, renderContext.intervalSize))
 
-    outfileObject.write("""
+    if blankCells > 0:
+        cells.append(blankCell % (blankCells * renderContext.intervalSize))
+
+    return """
 <table class="%s" cellpadding="0" cellspacing="0" border="0">
 <tr>
 <td class="ycell">
 <img src="img-static/no.gif" width="5" height="1" alt="" border="0" /></td>\n
-""" % tableClass)
+""" % tableClass + "".join(cells) + "</tr>\n</table>"
 
-    for section in timelineSections:
 
-        # print out all the labels in this section
-        date = section['startDate']
-        while date <= section['endDate']:
+def writeDateTable(outfileObject, tableClass, namePrefix, dateRange=None,
+                   suffix=""):
+    """Write a row of date labels across the timeline.
 
-            label = date.toString(monthSeparator="/")
-            name = date.toString(monthSeparator="_")
+    outfileObject -- file handle to write to
+    tableClass -- CSS class of the table
+    namePrefix -- prefix for the anchor names of the dates
+    dateRange -- (first month, last month) of the dates to label, if not all
+    suffix -- suffix of the file names of the page the table is on
 
-            outfileObject.write("""<td class="ycell">
-<a name="%s%s">%s</a><br />
-<img src="img-static/no.gif" width="%d" height="1" alt="" border="0" /></td>\n
-""" % (namePrefix, name, label, int(params['TIMELINE.intervalsize'])))
-            date = date + section['interval']
-        
-    outfileObject.write("</tr>\n</table>")
+    An incremental build reuses the table from the previous build if none
+    of the sections or label settings have changed.
+    """
+
+    if buildState is None:
+        outfileObject.write(buildDateTable(tableClass, namePrefix, dateRange))
+        return
+
+    dependencies = ([(int(section['startDate']), int(section['endDate']),
+                      int(section['interval']))
+                     for section in timelineSections],
+                    lvutils.dateResolutionDefaultsToYears,
+                    lvutils.alwaysPrint5DigitYears,
+                    renderContext.intervalSize, namePrefix, dateRange)
+
+    # each page of a split timeline has its own tables
+    fragmentName = tableClass + suffix
+
+    dateTable = buildState.getFragment(fragmentName, dependencies)
+    if dateTable is None:
+        dateTable = buildDateTable(tableClass, namePrefix, dateRange)
+        buildState.saveFragment(fragmentName, dependencies, dateTable)
+
+    outfileObject.write(dateTable)
+    return
+
+
+def buildMonthTables():
+    """Precompute the X coordinate and section of every month in the timeline.
+
+    Must be called after the startPixel and pixelsPerMonth of each section
+    have been calculated.  getSectionFromDate() and getStartXCoordFromDate()
+    are simple lookups into the tables built here.
+
+    The width of a month is the distance from its starting pixel to that of
+    the month after it, so the rounding error that builds up when a month
+    isn't a whole number of pixels wide is compensated for exactly once,
+    here, rather than by everything that draws months side by side.
+    """
+
+    global monthTableStart
+    global monthXCoords
+    global monthWidths
+    global monthSections
+
+    monthTableStart = int(min([section['startDate']
+                               for section in timelineSections]))
+    tableEnd = int(max([section['endDate'] for section in timelineSections]))
+
+    monthXCoords = array('l', [0]) * (tableEnd - monthTableStart + 1)
+    monthWidths = array('l', [0]) * (tableEnd - monthTableStart + 1)
+    monthSections = array('l', [-1]) * (tableEnd - monthTableStart + 1)
+
+    for sectionIndex in range(len(timelineSections)):
+        section = timelineSections[sectionIndex]
+        startPixel = section['startPixel']
+        pixelsPerMonth = section['pixelsPerMonth']
+
+        offset = section['startDate'] - monthTableStart
+        nextXCoord = int(round(startPixel))
+        for month in range(section['endDate'] - section['startDate'] + 1):
+
+            xCoord = nextXCoord
+            nextXCoord = int(round(startPixel + (month + 1) * pixelsPerMonth))
+
+            # if sections overlap, the earliest one wins
+            if monthSections[offset + month] != -1:
+                continue
 
+            monthSections[offset + month] = sectionIndex
+            monthXCoords[offset + month] = xCoord
+            monthWidths[offset + month] = nextXCoord - xCoord
     return
 
 
 def getSectionFromDate(date):
 
-    for section in timelineSections:
-        if date >= section['startDate'] and date <= section['endDate']:
-            return section
+    index = int(date) - monthTableStart
+    if index >= 0 and index < len(monthSections) \
+           and monthSections[index] != -1:
+        return timelineSections[monthSections[index]]
 
     warning = "warning: date %d is not contained in any section\n" % date
     sys.stderr.write(warning)
@@ -374,10 +917,53 @@ def getSectionFromDate(date):
 def getStartXCoordFromDate(date):
     """Return the starting X pixel for a given date"""
 
-    section = getSectionFromDate(date)
-    
-    return int(round(section['startPixel'] + (date - section['startDate']) \
-               * section['pixelsPerMonth']))
+    index = int(date) - monthTableStart
+    if index >= 0 and index < len(monthSections) \
+           and monthSections[index] != -1:
+        return monthXCoords[index]
+
+    # not in any section, so let getSectionFromDate() complain
+    getSectionFromDate(date)
+
+
+def buildRenderContext():
+    """Return a RenderContext built from params and the timeline sections."""
+
+    missingParams = {}
+
+    def optionalParam(attribute, name, convert):
+        if params.has_key(name):
+            return convert(params[name])
+        missingParams[attribute] = name
+        return None
+
+    nowDate = getnowdate()
+    nowBarStartXCoord = getStartXCoordFromDate(nowDate)
+    nowBarWidth = getnowbarwidth()
+
+    return RenderContext(
+        missingParams,
+        leftMargin=int(params['TIMELINE.leftmargin']),
+        intervalSize=int(params['TIMELINE.intervalsize']),
+        minBarWidth=int(params['TIMELINE.minbarwidth']),
+        resolutionInMonths=int(params['TIMELINE.resolutioninmonths']),
+        topFrameHeight=optionalParam('topFrameHeight',
+                                     'TIMELINE.topframeheight', str),
+        barHeight=getbarheight(),
+        diamondWidth=optionalParam('diamondWidth', 'EVENTBAR.diamondwidth',
+                                   int),
+        diamondLeftMargin=optionalParam('diamondLeftMargin',
+                                        'EVENTBAR.diamondleftmargin', int),
+        diamondVerticalMargin=optionalParam('diamondVerticalMargin',
+                                            'EVENTBAR.diamondverticalmargin',
+                                            int),
+        saturation=optionalParam('saturation', 'EVENTBAR.saturation', float),
+        nowBarOnTop=params.get('EVENTBAR.nowbarontop', False),
+        nowDate=nowDate,
+        nowBarStartXCoord=nowBarStartXCoord,
+        nowBarWidth=nowBarWidth,
+        nowBarVirtualWidth=getnowbarvirtualwidth(),
+        futureStartXCoord=nowBarStartXCoord + nowBarWidth)
 
 
 def getNowBarStartXCoord():
@@ -391,26 +977,57 @@ def getBarWidth(startDate, endDate):
 
     endSection = getSectionFromDate(endDate)
     width = getStartXCoordFromDate(endDate) \
-            + int(params['TIMELINE.resolutioninmonths']) \
+            + renderContext.resolutionInMonths \
             * endSection['pixelsPerMonth'] - getStartXCoordFromDate(startDate)
 
-    return max(int(round(width)), int(params['TIMELINE.minbarwidth']))
+    return max(int(round(width)), renderContext.minBarWidth)
+
+
+def layoutRows(rows):
+    """Calculate the pixel geometry of every timeline bar and subitem.
+
+    The results are stored in each row dictionary for the writers to use:
+    startPixel, barWidth, overlapsFuture (does any pixel of the bar fall in
+    the future?) and futureStartXCoord (where the future starts relative to
+    the bar, or None if the bar ends first).  Each subitem dictionary gets
+    xOffset, the X coordinate of the subitem relative to its bar.
+    """
+
+    futureFirstPixel = renderContext.futureStartXCoord
 
+    for row in rows:
+
+        startPixel = getStartXCoordFromDate(row['startDate'])
+        barWidth = getBarWidth(row['startDate'], row['endDate'])
+
+        row['startPixel'] = startPixel
+        row['barWidth'] = barWidth
+        row['overlapsFuture'] = startPixel + barWidth - 1 >= futureFirstPixel
+
+        if futureFirstPixel <= startPixel + barWidth:
+            row['futureStartXCoord'] = max(futureFirstPixel - startPixel, 0)
+        else:
+            row['futureStartXCoord'] = None
 
-def buildTimelineBar(nodeId, startDate, endDate, link, imagePath, args):
+        for subitem in row['subitems']:
+            subitem['xOffset'] = getStartXCoordFromDate(subitem['date']) \
+                                 - startPixel
+    return
+
+
+def buildTimelineBar(nodeId, startPixel, width, link, imagePath, args,
+                     svg=None):
     """Return the HTML for a timeline bar
 
     nodeId -- node in string form of the associated popup
-    startDate -- starting date of the bar as an LVDate
-    startDate -- ending date of the bar as an LVDate
+    startPixel -- X coordinate where the bar starts
+    width -- width of the bar in pixels
     link -- clickthrough URL.  may be zero-length, meaning no clickthrough
     imagePath -- pathname of the image to be used for this bar
     args -- any additional arguments from the data file
+    svg -- inline SVG to draw the bar with instead of an image, if any
     """
 
-    startPixel = getStartXCoordFromDate(startDate)
-    width = getBarWidth(startDate, endDate)
-
     if len(link) == 0:
         onClick = 'onclick="return false;" '
         href = 'javascript:;'
@@ -418,107 +1035,265 @@ def buildTimelineBar(nodeId, startDate, endDate, link, imagePath, args):
         onClick = ''
         href = link
 
+    if svg is not None:
+        return lvhtml.svgTimelineCell % (startPixel, href, nodeId, nodeId,
+                                         onClick, nodeId, svg)
+
     return lvhtml.timelineCell % (startPixel, href, nodeId, nodeId, onClick,
-                                  nodeId, imagePath, width, getbarheight())
+                                  nodeId, imagePath, width,
+                                  renderContext.barHeight)
 
 
-def writeTimelineBars(outfileObject, rows, outputDir, imageSubDir):
+def writeTimelineBars(outfileObject, rows, outputDir, imageSubDir,
+                      rowsFilename="rows.js"):
     """Write out the timeline bars, both HTML and PNGs.
 
     outfileObject -- file handle to write to
     rows -- the list of timeline bars
     outputDir -- directory to write output to
     imageSubDir -- the subdir of outputDir to write any generated images to
+    rowsFilename -- file in outputDir to write the rows to, if virtualRows
     """
 
     tableWidth = getBarWidth(gettimelinestartdate(), gettimelineenddate()) \
-                 + int(params['TIMELINE.leftmargin'])
+                 + renderContext.leftMargin
     
-    outfileObject.write("""<table id="datatable" cellpadding="0" cellspacing="0" border="0" width="%dpx">\n""" % tableWidth)
-
-    colorNum = 2
-    futureFirstPixel = getNowBarStartXCoord() + getnowbarwidth()
+    # a tiled background is composed behind the table
+    if tiledBackground:
+        futureStartXCoord = renderContext.nowBarStartXCoord \
+                            + renderContext.nowBarWidth
+        outfileObject.write(lvhtml.timelineBackgroundTop % (
+            tableWidth, renderContext.nowBarStartXCoord,
+            renderContext.nowBarWidth,
+            "#%02x%02x%02x" % tuple(params['TIMELINE.nowbarcolor']),
+            futureStartXCoord, max(tableWidth - futureStartXCoord, 0)))
     
+    if virtualRows:
+        outfileObject.write(lvhtml.virtualRowsTop %
+                            (tableWidth, len(rows) * getVirtualRowHeight()))
+        rowsFile = lvutils.ChunkedWriter(
+            open(os.path.join(outputDir, rowsFilename), "wt"))
+        rowsFile.write("loadRows(%d, [\n" % getVirtualRowHeight())
+    else:
+        outfileObject.write("""<table id="datatable" cellpadding="0" cellspacing="0" border="0" width="%dpx">\n""" % tableWidth)
+
     for row in rows:
 
-        # alternate the colors of the bars
+        colorNum = row['colorNum']
+
+        if virtualRows:
+
+            # the row's geometry and HTML, with its images loaded lazily
+            barFile = StringIO()
+            writeBar(barFile, row, outputDir, imageSubDir, colorNum)
+            if row is not rows[0]:
+                rowsFile.write(",\n")
+            rowsFile.write("[%d,%d,%s,%s]" % (
+                row['startPixel'], row['barWidth'],
+                quoteJavaScript(barFile.getvalue().replace(
+                    "<img ", '<img loading="lazy" ')),
+                quoteJavaScript(lvhtml.buildLabel(row['nodeId'], row['title'],
+                                                  row['link']))))
+            continue
+
+        outfileObject.write('<tr>\n<td class="data" nowrap="nowrap">\n')
+        writeBar(outfileObject, row, outputDir, imageSubDir, colorNum)
+        outfileObject.write("</td>\n</tr>\n\n")
+
+    if virtualRows:
+        rowsFile.write("]);\n")
+        rowsFile.close()
+        outfileObject.write(lvhtml.virtualRowsBottom)
+    else:
+        outfileObject.write("</table>\n")
+    if tiledBackground:
+        outfileObject.write(lvhtml.timelineBackgroundBottom)
+
+    # wait for any bar images that are still being rendered
+    finishBarImages()
+    return
+
+
+def assignBarColors(rows):
+    """Alternate the colors of the bars down the whole timeline.
+
+    A row on more than one page of a split timeline has the same color on
+    each of them, since they all share its image.
+    """
+
+    colorNum = 2
+    for row in rows:
         if colorNum == 1:
             colorNum = 2
         else:
             colorNum = 1
+        row['colorNum'] = colorNum
 
-        # calculate the last pixel in this bar; we need to see if this
-        # overlaps with the future area, in which case we need to render
-        # this bar as an image.
-        startPixel = getStartXCoordFromDate(row['startDate'])
-        barLastPixel = getBarWidth(row['startDate'], row['endDate']) \
-                        + startPixel - 1
+    return
 
-        outfileObject.write('<tr>\n<td class="data" nowrap="nowrap">\n')
 
-        if len(row['subitems']) > 0 or barLastPixel >= futureFirstPixel or \
-               interestData.has_key(row['nodeId']):
-            writeImageBar(outfileObject, row, outputDir, imageSubDir,
-                          colorNum)
-        else:
-            try:
-                outfileObject.write(
-                    buildTimelineBar(row['nodeId'], row['startDate'],
-                                     row['endDate'], row['link'],
-                                     "%s/color%d.png" %
-                                     (imageSubDir, colorNum), row['args']))
-            except IndexError:
-                sys.stderr.write("; timeline bar skipped")
+def writeBar(outfileObject, row, outputDir, imageSubDir, colorNum):
+    """Write out the HTML for a timeline bar, and its PNG if it needs one.
 
-        outfileObject.write("</td>\n</tr>\n\n")
+    outfileObject -- file handle to write to
+    row -- from the global rows[] array
+    outputDir -- directory to write output to
+    imageSubDir -- the subdir of outputDir to write any generated images to
+    colorNum -- which of the alternating bar colors to use
+    """
 
-    outfileObject.write("</table>\n")
+    if needsBarImage(row):
+        writeImageBar(outfileObject, row, outputDir, imageSubDir, colorNum)
+    else:
+        outfileObject.write(
+            buildTimelineBar(row['nodeId'], row['startPixel'],
+                             row['barWidth'], row['link'],
+                             "%s/color%d.png" % (imageSubDir, colorNum),
+                             row['args']))
     return
 
 
-def writeSubItems(outfileObject, row, barImage):
-    """Write all the subitem diamonds and area elements for this row
+def needsBarImage(row):
+    """Return whether a row's bar is drawn as an image of its own.
 
-    outfileObject -- file object to write to
     row -- from the global rows[] array
-    barImage -- SlicedImage object for this event bar
     """
 
-    barWidth = getBarWidth(row['startDate'], row['endDate'])
-    startPixel = getStartXCoordFromDate(row['startDate'])
-    
-    # we do want an imagemap if there are subitems
-    outfileObject.write('<map name="node%smap" id="node%smap">\n' %
-                        (row['nodeId'], row['nodeId']))
+    # if this bar overlaps with the future area, we need to render it
+    # as an image.
+    return len(row['subitems']) > 0 or row['overlapsFuture'] or \
+           interestData.has_key(row['nodeId'])
+
+
+def writeBarImages(rows, outputDir, imageSubDir):
+    """Write out the PNGs for these rows, without any of their HTML.
+
+    rows -- the list of timeline bars
+    outputDir -- directory to write output to
+    imageSubDir -- the subdir of outputDir to write the images to
+
+    This is for when the HTML is reused from the previous build, but the
+    images still need checking one by one, in case any of them changed or
+    went missing from the previous output.
+    """
+
+    # inline SVG bars don't have any images
+    if svgBars:
+        return
+
+    for row in rows:
+        if needsBarImage(row):
+            barImage, subitemAreas = buildBarImage(row, row['colorNum'])
+            writeBarImage(row, barImage, outputDir, imageSubDir)
+
+    # wait for any bar images that are still being rendered
+    finishBarImages()
+    return
+
+
+def getVirtualRowHeight():
+    """Return the height in pixels of a row of the timeline: a bar plus the
+    padding above and below it that the .data style in the stylesheets
+    gives it.
+    """
+
+    top, bottom = lvhtml.getVerticalPadding(lvhtml.stylesheets, ".data")
+    return renderContext.barHeight + top + bottom
+
+
+def queueBarImage(barImage, filename):
+    """Render a bar image, in the background if there's a process pool.
+
+    barImage -- sliceMaker.SlicedImageSpec describing the image
+    filename -- file to write the PNG to
+    """
+
+    if barImagePool is None:
+        sliceMaker.renderSlicedImage(barImage, filename, barImageCache)
+    else:
+        pendingBarImages.append(barImagePool.apply_async(
+            sliceMaker.renderSlicedImage,
+            (barImage, filename, barImageCache)))
+    return
+
+
+def finishBarImages():
+    """Wait for all queued bar images to be written.
+
+    Any exception raised while rendering an image is raised again here.
+    """
+
+    global pendingBarImages
+
+    for result in pendingBarImages:
+        result.get()
+    pendingBarImages = []
+
+    return
+
+
+def drawSubItems(row, barImage):
+    """Draw the subitem diamonds for this row into its bar image
+
+    row -- from the global rows[] array
+    barImage -- SlicedImageSpec object for this event bar
+
+    Returns a list of the (node string, x1, x2) of each diamond, for
+    writeSubItems() or writeSvgBar().
+    """
+
+    barWidth = row['barWidth']
+    subitemAreas = []
 
     # generate an area for each subitem
     subitemLetter = 97 # 'a'
 
     for subitem in row['subitems']:
 
-        x1 = getStartXCoordFromDate(subitem['date']) - startPixel
+        x1 = subitem['xOffset']
 
         # if the diamond would be off the right end of the bar, nudge it
         # to the left just enough
-        if x1 > barWidth - int(params['EVENTBAR.diamondwidth']):
-            x1 -= int(params['EVENTBAR.diamondwidth'])
+        if x1 > barWidth - barImage.diamondWidth:
+            x1 -= barImage.diamondWidth
                 
-        x2 = x1 + int(params['EVENTBAR.diamondwidth'])
+        x2 = x1 + barImage.diamondWidth
 
-        # generate the HTML for this <area>
-        outfileObject.write(
-            lvhtml.buildAreaElement("rect", row['nodeId'] + chr(subitemLetter),
-                                    x1, 0, x2, getbarheight() - 1))
+        subitemAreas.append((row['nodeId'] + chr(subitemLetter), x1, x2))
 
         # draw the diamond into the bar
         barImage.drawDiamond(x1)
         
         subitemLetter += 1
+
+    return subitemAreas
+
+
+def writeSubItems(outfileObject, row, subitemAreas):
+    """Write the imagemap and HTML for a bar image with subitems
+
+    outfileObject -- file object to write to
+    row -- from the global rows[] array
+    subitemAreas -- list of the (node string, x1, x2) of each subitem
+    """
+
+    barWidth = row['barWidth']
+    startPixel = row['startPixel']
+    
+    # we do want an imagemap if there are subitems
+    outfileObject.write('<map name="node%smap" id="node%smap">\n' %
+                        (row['nodeId'], row['nodeId']))
+
+    # generate an area for each subitem
+    for nodeString, x1, x2 in subitemAreas:
+        outfileObject.write(
+            lvhtml.buildAreaElement("rect", nodeString,
+                                    x1, 0, x2, renderContext.barHeight - 1))
         
     # imagemap default area
     outfileObject.write(
         lvhtml.buildAreaElement("default", row['nodeId'], 0, 0, barWidth,
-                                getbarheight()))
+                                renderContext.barHeight))
 
     # imagemap footer
     outfileObject.write('</map>\n')
@@ -526,9 +1301,42 @@ def writeSubItems(outfileObject, row, barImage):
     # html for the bar itself
     outfileObject.write(lvhtml.generatedBar %
                         (startPixel, row['nodeId'], barWidth,
-                         getbarheight(), row['nodeId']))
+                         renderContext.barHeight, row['nodeId']))
     return
 
+
+def writeSvgBar(outfileObject, row, barImage, subitemAreas):
+    """Write the HTML for a bar image as inline SVG
+
+    outfileObject -- file object to write to
+    row -- from the global rows[] array
+    barImage -- SlicedImageSpec object for this event bar
+    subitemAreas -- list of the (node string, x1, x2) of each subitem, or
+                    None if the bar has no subitems
+    """
+
+    svgImage = sliceMaker.buildSvgImage(barImage)
+
+    if subitemAreas is None:
+        outfileObject.write(
+            buildTimelineBar(row['nodeId'], row['startPixel'],
+                             row['barWidth'], row['link'], None, row['args'],
+                             svgImage.getSvg()))
+        return
+
+    # the whole bar shows the row's popup, except where the subitems'
+    # shapes are on top of it
+    areas = [lvhtml.buildSvgArea(row['nodeId'], 0, 0, row['barWidth'],
+                                 renderContext.barHeight)]
+    for nodeString, x1, x2 in subitemAreas:
+        areas.append(lvhtml.buildSvgArea(nodeString, x1, 0, x2 - x1 + 1,
+                                         renderContext.barHeight))
+
+    outfileObject.write(lvhtml.svgGeneratedBar %
+                        (row['startPixel'], svgImage.getSvg("".join(areas))))
+    return
+
+
 def writeInterestSlices(barImage, row):
     """Write the interest slices for this into the given image
 
@@ -536,45 +1344,32 @@ def writeInterestSlices(barImage, row):
     row -- data for this event bar
     """
 
-    # build a slice for every month in the bar until now
-    leapPixels = 0        
-    month = row['startDate']
-    while month <= min(getnowdate(), row['endDate']):
-
-        # need this to for figuring out month width
-        sliceSection = getSectionFromDate(month)
-
-        # keep track of the amount of pixels lost to rounding errors
-        fraction, integer = math.modf(sliceSection['pixelsPerMonth'])
-        if fraction < .5:
-            leapPixels += fraction
-        else:
-            leapPixels -= 1-fraction
+    # build a slice for every month in the bar until now.  The widths
+    # already include any compensation for rounding errors (see
+    # buildMonthTables()).  Months are plain ints here, to save building
+    # an LVDate for each one; they look up interest data all the same.
+    month = int(row['startDate'])
+    lastMonth = int(min(renderContext.nowDate, row['endDate']))
+    sliceWidths = monthWidths[month - monthTableStart:
+                              lastMonth - monthTableStart + 1]
+    interest = interestData[row['nodeId']]
 
-        # if the number of pixels lost/gained >= 1, compensate
-        paddingPixels = 0
-        if leapPixels >= 1.0:
-            paddingPixels = 1
-            leapPixels -= 1.0
-        elif leapPixels <= -1.0:
-            paddingPixels = -1
-            leapPixels += 1.0
+    for sliceWidth in sliceWidths:
 
         # if we're at the last interest slice, which is drawn over the
         # now bar, we may need to add some pixels of padding to
         # compensate for the fact that the now bar may be bigger than
         # it ought to because of the minimum bar width
-        if month == min(getnowdate(), row['endDate']): 
-            paddingPixels += int(round((getnowbarwidth() -
-                                        getnowbarvirtualwidth()))) - 1
+        if month == lastMonth: 
+            sliceWidth += int(round((renderContext.nowBarWidth -
+                                     renderContext.nowBarVirtualWidth))) - 1
 
-        if not interestData[row['nodeId']].has_key(month):
+        if not interest.has_key(month):
 
             # build "no-data" slice
             barImage.addSlice(
-                {'height': getbarheight(),
-                 'width': int(round(sliceSection['pixelsPerMonth']))
-                 + paddingPixels, 'lowerSize': 1.0,
+                {'height': renderContext.barHeight,
+                 'width': sliceWidth, 'lowerSize': 1.0,
                  'lowerColor': params['EVENTBAR.nodatacolor'],
                  'dividerColor': params['EVENTBAR.nodatacolor'],
                  'upperColor': params['EVENTBAR.nodatacolor'],
@@ -583,7 +1378,7 @@ def writeInterestSlices(barImage, row):
             month += 1
             continue
 
-        interestSlice = interestData[row['nodeId']][month]
+        interestSlice = interest[month]
             
         # figure out the ratio of "no" votes, avoiding zero division
         if interestSlice['noVotes'] == 0 and interestSlice['yesVotes'] == 0:
@@ -606,13 +1401,12 @@ def writeInterestSlices(barImage, row):
             relativePosts = interestSlice['discussionPosts'] / maxPosts
             
         barImage.addSlice(
-            {'height': getbarheight(),
-             'width': int(round(sliceSection['pixelsPerMonth'])) \
-             + paddingPixels, 'lowerSize': noRatio,
+            {'height': renderContext.barHeight,
+             'width': sliceWidth, 'lowerSize': noRatio,
              'lowerColor': params['EVENTBAR.nocolor'],
              'dividerColor': params['EVENTBAR.nocolor'],
              'upperColor': params['EVENTBAR.yescolor'],
-             'saturation': float(params['EVENTBAR.saturation']),
+             'saturation': renderContext.require('saturation'),
              'brightness': 1 - relativePosts})
 
         month +=1
@@ -630,25 +1424,50 @@ def writeImageBar(outfileObject, row, outputDir, imageSubDir,
     imageSubDir -- subdirectory of outputDir to write generated images to
     colorNum -- which of the bar colors (either 1 or 2) is the background
     """
-    
-    startPixel = getStartXCoordFromDate(row['startDate'])
 
-    barWidth = getBarWidth(row['startDate'], row['endDate'])
+    barImage, subitemAreas = buildBarImage(row, colorNum)
 
-    # do we need a future section?
-    futureAbsoluteStartXCoord = getNowBarStartXCoord() + getnowbarwidth()
-    if futureAbsoluteStartXCoord <= startPixel + barWidth:
-        futureStartXCoord = max(futureAbsoluteStartXCoord - startPixel, 0)
+    # inline SVG bars don't need a PNG at all
+    if svgBars:
+        writeSvgBar(outfileObject, row, barImage, subitemAreas)
+        return
+
+    if subitemAreas is not None:
+        writeSubItems(outfileObject, row, subitemAreas)
     else:
-        futureStartXCoord = None
+        outfileObject.write(
+            buildTimelineBar(row['nodeId'], row['startPixel'],
+                             row['barWidth'], row['link'],
+                             os.path.join(imageSubDir, row['nodeId'] + ".png"),
+                             row['args']))
+
+    writeBarImage(row, barImage, outputDir, imageSubDir)
+    return
+
+
+def buildBarImage(row, colorNum):
+    """Describe the image for a bar, possibly with subitem diamonds
+
+    row -- dictionary of the properties of this row
+    colorNum -- which of the bar colors (either 1 or 2) is the background
 
-    # create the image
-    barImage = sliceMaker.SlicedImage(barWidth, getbarheight())
+    Returns the sliceMaker.SlicedImageSpec of the image, and the subitem
+    areas from drawSubItems(), or None if the bar has no subitems.
+    """
+    
+    startPixel = row['startPixel']
+    barWidth = row['barWidth']
 
-    barImage.diamondWidth = int(params['EVENTBAR.diamondwidth'])
-    barImage.diamondLeftMargin = int(params['EVENTBAR.diamondleftmargin'])
-    barImage.diamondVerticalMargin = int(
-        params['EVENTBAR.diamondverticalmargin'])
+    # do we need a future section?
+    futureStartXCoord = row['futureStartXCoord']
+
+    # describe the image; it gets drawn by queueBarImage()
+    barImage = sliceMaker.SlicedImageSpec(barWidth, renderContext.barHeight)
+
+    barImage.diamondWidth = renderContext.require('diamondWidth')
+    barImage.diamondLeftMargin = renderContext.require('diamondLeftMargin')
+    barImage.diamondVerticalMargin = renderContext.require(
+        'diamondVerticalMargin')
 
     # if this bar has interest data, use slicemaker to construct it
     if (interestData.has_key(row['nodeId'])):
@@ -663,7 +1482,7 @@ def writeImageBar(outfileObject, row, outputDir, imageSubDir,
             nonFutureSliceWidth = futureStartXCoord
             
         barImage.addSlice(
-            {'height': getbarheight(), 'width': nonFutureSliceWidth,
+            {'height': renderContext.barHeight, 'width': nonFutureSliceWidth,
              'lowerSize': 1.0,
              'lowerColor': params['EVENTBAR.color%d' % colorNum],
              'dividerColor': params['EVENTBAR.color%d' % colorNum],
@@ -672,7 +1491,7 @@ def writeImageBar(outfileObject, row, outputDir, imageSubDir,
              
     # add future slice, if necessary
     if futureStartXCoord is not None:
-        barImage.addSlice({'height': getbarheight(),
+        barImage.addSlice({'height': renderContext.barHeight,
                            'width': barWidth - futureStartXCoord,
                            'lowerSize': 1.0,
                            'lowerColor': params['EVENTBAR.futurecolor'],
@@ -681,43 +1500,125 @@ def writeImageBar(outfileObject, row, outputDir, imageSubDir,
                            'saturation': 1.0,
                            'brightness': 1.0})
     
+    subitemAreas = None
     if len(row['subitems']) > 0:
-        writeSubItems(outfileObject, row, barImage)
-    else:
-        outfileObject.write(
-            buildTimelineBar(row['nodeId'], row['startDate'], row['endDate'],
-                             row['link'],
-                             os.path.join(imageSubDir, row['nodeId'] + ".png"),
-                             row['args']))
+        subitemAreas = drawSubItems(row, barImage)
 
-    if params.has_key('EVENTBAR.nowbarontop'):
-        if params['EVENTBAR.nowbarontop']:
-            barImage.drawFilledSlice(getNowBarStartXCoord() - startPixel,
-                                     getnowbarwidth(),
-                                     params['TIMELINE.nowbarcolor'])
-            
-    # write out the PNG
-    barImage.generate(os.path.join(outputDir, imageSubDir,
-                                   row['nodeId'] + ".png"))
+    if renderContext.nowBarOnTop:
+        barImage.drawFilledSlice(
+            renderContext.nowBarStartXCoord - startPixel,
+            renderContext.nowBarWidth, params['TIMELINE.nowbarcolor'])
+
+    return barImage, subitemAreas
+
+
+def writeBarImage(row, barImage, outputDir, imageSubDir):
+    """Write the PNG for a bar image
+
+    row -- dictionary of the properties of this row
+    barImage -- sliceMaker.SlicedImageSpec from buildBarImage()
+    outputDir -- directory where all output is written
+    imageSubDir -- subdirectory of outputDir to write generated images to
+    """
+
+    # a row on more than one page only needs its PNG written once
+    filename = os.path.join(outputDir, imageSubDir, row['nodeId'] + ".png")
+    if writtenBarImages.has_key(filename):
+        return
+    writtenBarImages[filename] = True
+
+    # write out the PNG, unless the previous build already drew this one
+    if not reuseOutput(imageSubDir + "/" + row['nodeId'] + ".png", outputDir,
+                       barImage.getDescription()):
+        queueBarImage(barImage, filename)
     return
 
 
-def writeTimelineFrame(rows, outputDir):
-    """Write the HTML for the timeline frame."""
+def writeTimelineFrame(rows, outputDir, page=None):
+    """Write the HTML for the timeline frame.
+
+    rows -- the rows to write
+    outputDir -- directory to write it into
+    page -- from the global timelinePages[], if the timeline is split
+    """
+
+    if page is None:
+        suffix = ""
+        dateRange = None
+    else:
+        suffix = page['suffix']
+        dateRange = (page['startDate'], page['endDate'])
+    filename = "timeline%s.html" % suffix
+    rowsFilename = "rows%s.js" % suffix
+
+    dependencies = (dateRange,
+                    [describeRow(row) for row in rows], sorted(params.items()),
+                    [sorted(section.items()) for section in timelineSections],
+                    sorted(renderContext.__dict__.items()), maxPosts,
+                    pastArrowImageWidth, futureArrowImageWidth,
+                    tiledBackground, svgBars, lazyPopups, popupsPerShard,
+                    virtualRows, getVirtualRowHeight(),
+                    describeTemplateSymbols(
+                        'timelineTop', 'timelinePastNowTable',
+                        'timelineBottom', 'popupTemplate', 'notifyTemplate',
+                        'buildLabel', 'timelineCell', 'generatedBar',
+                        'buildAreaElement', 'timelineBackgroundTop',
+                        'timelineBackgroundBottom', 'svgTimelineCell',
+                        'svgGeneratedBar', 'buildSvgArea', 'lazyPopupScript',
+                        'virtualRowsTop', 'virtualRowsBottom',
+                        'virtualLabels'))
+
+    # the popup shards are small enough to just write out every time
+    if lazyPopups:
+        popupScript = writePopupShards(rows, outputDir, suffix)
+
+    # a virtual timeline's rows file goes with the page, but is checked on
+    # its own in case it went missing from the previous output
+    rowsReused = virtualRows and reuseOutput(rowsFilename, outputDir,
+                                             dependencies)
+
+    if reuseOutput(filename, outputDir, dependencies):
+
+        if virtualRows and not rowsReused:
+            nullFile = open(os.devnull, "wt")
+            writeTimelineBars(nullFile, rows, outputDir, "img-generated",
+                              rowsFilename)
+            nullFile.close()
+        else:
+            writeBarImages(rows, outputDir, "img-generated")
+
+        # hang on to the page's date tables for when it does change
+        if buildState is not None:
+            buildState.keepFragment("ytabletop" + suffix)
+            buildState.keepFragment("ytablebottom" + suffix)
+        return
     
-    timelineFile = open(os.path.join(outputDir, "timeline.html"), "wt")
+    # the page is made of a great many small pieces; collect them into large
+    # chunks rather than handing each one to the file
+    timelineFile = lvutils.ChunkedWriter(
+        open(os.path.join(outputDir, filename), "wt"))
     timelineFile.write(lvhtml.timelineTop % gettitle())
-    writePopups(timelineFile, rows)
-    writeDateTable(timelineFile, "ytabletop", "")
+    if lazyPopups:
+        timelineFile.write(popupScript)
+    else:
+        writePopups(timelineFile, rows)
+    writeDateTable(timelineFile, "ytabletop", "", dateRange, suffix)
     timelineFile.write(lvhtml.timelinePastNowTable %
-                       (getNowBarStartXCoord() + int(round(getnowbarwidth()/2))
+                       (renderContext.nowBarStartXCoord
+                        + int(round(renderContext.nowBarWidth/2))
                         - pastArrowImageWidth,
                        pastArrowImageWidth, futureArrowImageWidth))
-    writeTimelineBars(timelineFile, rows, outputDir, "img-generated")
-    writeDateTable(timelineFile, "ytablebottom", "b")
+    writeTimelineBars(timelineFile, rows, outputDir, "img-generated",
+                      rowsFilename)
+    writeDateTable(timelineFile, "ytablebottom", "b", dateRange, suffix)
     timelineFile.write("\n\n<br /><br /><br /><br /><br /><br />\n\n")
     timelineFile.write('<div id="mysteriousfuture">\n\n\n</div>\n\n\n')
-    writeLabels(timelineFile, rows)
+    if virtualRows:
+        timelineFile.write(lvhtml.virtualLabels %
+                           (len(rows) * getVirtualRowHeight(),
+                            rowsFilename))
+    else:
+        writeLabels(timelineFile, rows)
     timelineFile.write(lvhtml.timelineBottom)
     timelineFile.close()
     return
@@ -728,6 +1629,9 @@ def writeTimelineBackground(outputDir):
 
     outputDir -- output directory for the HTML.  The PNG will be written to
                  outputDir/img-generated/timeline-bg.html.
+
+    If the background is tiled, timeline-bg.png is just one repeating tile
+    and the future stippling goes in img-generated/timeline-future.png.
     """
 
     # width of the image is the starting pixel of the last month displayed,
@@ -735,28 +1639,145 @@ def writeTimelineBackground(outputDir):
     endDate = timelineSections[len(timelineSections)-1]['endDate']
     width = getStartXCoordFromDate(endDate) + \
             int(round(getSectionFromDate(endDate)['pixelsPerMonth']
-                  * int(params['TIMELINE.resolutioninmonths'])))
+                  * renderContext.resolutionInMonths))
 
-    bg = lvutils.Background(width, getbarheight() + 1, getNowBarStartXCoord())
+    bg = lvutils.Background(width, renderContext.barHeight + 1,
+                            renderContext.nowBarStartXCoord)
     bg.nowColor = params['TIMELINE.nowbarcolor']
     if params.has_key('TIMELINE.backgroundstipplecolor'):
         bg.stippleColor = params['TIMELINE.backgroundstipplecolor']
-    bg.dividerWidth = int(params['TIMELINE.minbarwidth'])
-    bg.nowWidth = getnowbarwidth()
-    bg.generate(os.path.join(outputDir, "img-generated", "timeline-bg.png"))
+    bg.dividerWidth = renderContext.minBarWidth
+    bg.nowWidth = renderContext.nowBarWidth
+
+    dependencies = (width, renderContext.barHeight,
+                    renderContext.nowBarStartXCoord, renderContext.nowBarWidth,
+                    renderContext.minBarWidth, params['TIMELINE.nowbarcolor'],
+                    params.get('TIMELINE.backgroundstipplecolor'),
+                    tiledBackground)
+
+    if not tiledBackground:
+        if not reuseOutput("img-generated/timeline-bg.png", outputDir,
+                           dependencies):
+            bg.generate(os.path.join(outputDir, "img-generated",
+                                     "timeline-bg.png"))
+        return
+
+    if not reuseOutput("img-generated/timeline-bg.png", outputDir,
+                       dependencies):
+        bg.generateTile(os.path.join(outputDir, "img-generated",
+                                     "timeline-bg.png"))
+    if not reuseOutput("img-generated/timeline-future.png", outputDir,
+                       dependencies):
+        bg.generateFutureTile(os.path.join(outputDir, "img-generated",
+                                           "timeline-future.png"))
 
     return
 
 
+def buildTimelinePages(split, rows):
+    """Return the pages to split the timeline into.
+
+    split -- "sections" for a page per timeline section, or else the number
+             of years each page should cover
+    rows -- the list of timeline bars
+
+    Each page is a dictionary of the first and last month it covers, and the
+    suffix of its file names.  A stretch of time that no row starts in is
+    added on to the page before it rather than getting a page of its own,
+    since it would only repeat rows from that page.  The page with the now
+    cell's date on it is the one index.html shows first, so it keeps the
+    plain timeline.html; the others are timeline-1.html and so on.
+    """
+
+    if split == "sections":
+        ranges = [(int(section['startDate']), int(section['endDate']))
+                  for section in timelineSections]
+    else:
+        months = int(split) * 12
+        ranges = []
+        date = int(gettimelinestartdate())
+        while date <= int(gettimelineenddate()):
+            ranges.append((date,
+                           min(date + months - 1, int(gettimelineenddate()))))
+            date += months
+
+    rowStartDates = [int(row['startDate']) for row in rows]
+    rowStartDates.sort()
+
+    # every row on a stretch that no row starts in is on the page before it
+    # already, so such a stretch is added on to that page
+    pages = []
+    pageStartsRows = False
+    for startDate, endDate in ranges:
+        startsRows = bisect_right(rowStartDates, endDate) > \
+                     bisect_left(rowStartDates, startDate)
+        if len(pages) > 0 and not (startsRows and pageStartsRows):
+            pages[-1]['endDate'] = endDate
+            pageStartsRows = pageStartsRows or startsRows
+        else:
+            pages.append({'startDate': startDate, 'endDate': endDate})
+            pageStartsRows = startsRows
+
+    nowDate = int([navcell for navcell in navcells if navcell['now']][0]
+                  ['date'])
+
+    pageNum = 1
+    for page in pages:
+        if page['startDate'] <= nowDate <= page['endDate']:
+            page['suffix'] = ""
+        else:
+            page['suffix'] = "-%d" % pageNum
+        pageNum += 1
+
+    # if now isn't on any page, the first page is the one shown first
+    if not [page for page in pages if page['suffix'] == ""]:
+        pages[0]['suffix'] = ""
+
+    return pages
+
+
+def getTimelinePage(date):
+    """Return the page of the split timeline with date on it.
+
+    date -- LVDate or month number to look for
+    """
+
+    for page in timelinePages:
+        if page['startDate'] <= date <= page['endDate']:
+            return page
+
+    # dates off either end of the timeline go to the nearer end
+    if date < timelinePages[0]['startDate']:
+        return timelinePages[0]
+    return timelinePages[-1]
+
+
+def getPageRows(rows, page):
+    """Return the rows that overlap with a page of the split timeline.
+
+    rows -- the list of timeline bars
+    page -- from the global timelinePages[]
+    """
+
+    return [row for row in rows
+            if int(row['startDate']) <= page['endDate'] and
+            int(row['endDate']) >= page['startDate']]
+
+
 def writeIndex(outputDir):
     """Write the index (main page) for the HTML frameset
 
     outputDir -- directory to write it into
     """
+
+    if reuseOutput("index.html", outputDir,
+                   (gettitle(), renderContext.require('topFrameHeight'),
+                    getnowcellanchor(), describeTemplateSymbols('indexHtml'))):
+        return
     
     indexFile = open(os.path.join(outputDir, "index.html"), "wt")
     indexFile.write(lvhtml.indexHtml % (gettitle(),
-                                        params['TIMELINE.topframeheight'],
+                                        renderContext.topFrameHeight,
                                         getnowcellanchor()))
     indexFile.close()
     return
@@ -767,6 +1788,16 @@ def writeHeaderFrame(outputDir):
 
     outputDir -- directory to write it into
     """
+
+    if reuseOutput("header.html", outputDir,
+                   (gettitle(), params['TIMELINE.title'],
+                    [(int(section['startDate']), int(section['endDate']))
+                     for section in timelineSections],
+                    [sorted(navcell.items()) for navcell in navcells],
+                    timelinePages,
+                    describeTemplateSymbols('headerTop', 'headerBottom',
+                                            'buildnavcell'))):
+        return
     
     headerFile = open(outputDir + "/header.html", "wt")
     headerFile.write(lvhtml.headerTop %
@@ -795,9 +1826,17 @@ def writeHeaderFrame(outputDir):
 
         # since this is an anchor name, we need to use "_" instead of "/"
         dateString = navcell['date'].toString(monthSeparator="_")
-        headerFile.write(
-            lvhtml.buildnavcell(anchorPrefix, dateString, onImage, offImage,
-                                cellName))
+        if timelinePages is None:
+            headerFile.write(
+                lvhtml.buildnavcell(anchorPrefix, dateString, onImage,
+                                    offImage, cellName))
+        else:
+            # link to the page with this date on it
+            headerFile.write(
+                lvhtml.buildnavcell(anchorPrefix, dateString, onImage,
+                                    offImage, cellName,
+                                    "timeline%s.html" % getTimelinePage(
+                                        navcell['date'])['suffix']))
         cellcount += 1
 
     headerFile.write(lvhtml.headerBottom %
@@ -811,26 +1850,29 @@ def readDataFile(dataFile):
 
     rows = []
     reader = csv.reader(open(dataFile, "rt"))
+    dataRows = list(reader)
 
-    for row in reader:
+    # column 1 is a date in both regular rows and sub-items
+    dates = lvutils.LVDate.parseColumn(dataRows, 1)
+
+    for row, date in zip(dataRows, dates):
 
         if row[0] != "":
 
             # check enddate to see if it's the special "?", which
             # represents now, but converts differently to a string
             if row[2] == "?":
-                endDate = lvutils.LVDate(getnowdate())
-                endDate.ongoing = True
+                endDate = lvutils.OngoingLVDate(renderContext.nowDate)
             else:
                 endDate = lvutils.LVDate(row[2])
             
             # a regular row
-            rows.append({'nodeId': row[0], 'startDate': lvutils.LVDate(row[1]),
+            rows.append({'nodeId': row[0], 'startDate': date,
                          'endDate': endDate, 'link': row[3],
                          'title': row[4], 'args': row[5:], 'subitems': []})
         else:
             # a sub-item
-            rows[-1]['subitems'].append({'date': lvutils.LVDate(row[1]),
+            rows[-1]['subitems'].append({'date': date,
                                          'link': row[2], 'args': row[3:]})
 
     return rows
@@ -846,16 +1888,17 @@ def readInterestFile(interestFile):
     global maxPosts
 
     reader = csv.reader(open(interestFile, "rt"))
-    for row in reader:
+    interestRows = list(reader)
+    dates = lvutils.LVDate.parseColumn(interestRows, 1)
+
+    for row, date in zip(interestRows, dates):
         if not interestData.has_key(row[0]):
             interestData[row[0]] = {}
-        interestData[row[0]][lvutils.LVDate(row[1])] = \
-                                                     {'yesVotes': int(row[2]),
-                                                      'noVotes': int(row[3])}
+        interestData[row[0]][date] = {'yesVotes': int(row[2]),
+                                      'noVotes': int(row[3])}
         # only add the discussion post info if it's there
         if len(row) == 5:
-            interestData[row[0]][lvutils.LVDate(row[1])]['discussionPosts'] = \
-                                                      int(row[4])
+            interestData[row[0]][date]['discussionPosts'] = int(row[4])
             # useful later for calculating relative discussion intensity
             if int(row[4]) > maxPosts:
                 maxPosts = int(row[4])
@@ -1126,8 +2169,70 @@ parser.add_option("-p", "--prototype-dir", type="string", dest="protoDir",
 parser.add_option("-o", "--output-dir", type="string", dest="outputDir",
                   help="directory to write output to",
                   default="html")
+if lvraster.backends.has_key('gd'):
+    defaultRasterBackend = 'gd'
+else:
+    defaultRasterBackend = 'python'
+parser.add_option("-r", "--raster-backend", type="choice",
+                  dest="rasterBackend", choices=lvraster.backends.keys(),
+                  help="module to draw images with: gd (if installed) or "
+                  "python [default: %default]",
+                  default=defaultRasterBackend)
+parser.add_option("-j", "--jobs", type="int", dest="jobs",
+                  help="number of processes to render bar images with "
+                  "[default: %default]", default=1)
+parser.add_option("-c", "--image-cache", type="string", dest="imageCache",
+                  help="directory to keep bar images in for reuse by later "
+                  "runs [default: no cache]")
+parser.add_option("--image-cache-size", type="int", dest="imageCacheSize",
+                  help="maximum size of the image cache, in megabytes "
+                  "[default: %default]", default=100)
+parser.add_option("-i", "--incremental", action="store_true",
+                  dest="incremental", help="only regenerate files whose "
+                  "inputs changed since the last incremental build",
+                  default=False)
+parser.add_option("--tiled-background", action="store_true",
+                  dest="tiledBackground", help="draw the timeline background "
+                  "as small repeating tiles instead of one wide image",
+                  default=False)
+parser.add_option("--svg-bars", action="store_true", dest="svgBars",
+                  help="draw bars with interest data, subitems or future "
+                  "sections as inline SVG instead of PNGs", default=False)
+parser.add_option("--lazy-popups", action="store_true", dest="lazyPopups",
+                  help="load popups from separate files when first shown "
+                  "instead of writing them all into timeline.html",
+                  default=False)
+parser.add_option("--virtual-rows", action="store_true", dest="virtualRows",
+                  help="only put the rows that are in view into the page, "
+                  "for very large timelines", default=False)
+parser.add_option("-z", "--gzip", action="store_true", dest="gzipSiblings",
+                  help="keep a gzipped copy of each HTML, CSS and JavaScript "
+                  "file in the output directory, for the web server to send "
+                  "as is", default=False)
+parser.add_option("-m", "--minify", action="store_true", dest="minify",
+                  help="take the comments and excess whitespace out of the "
+                  "HTML and CSS templates", default=False)
+parser.add_option("-s", "--split-timeline", type="string",
+                  dest="splitTimeline", metavar="sections|YEARS",
+                  help="split the timeline into a page per timeline section, "
+                  "or per this many years, each with just the rows on it")
+parser.add_option("-O", "--optimize-images", action="store_true",
+                  dest="optimizeImages", help="recompress the generated "
+                  "images as compactly as possible, and report the savings",
+                  default=False)
 (options, args) = parser.parse_args()
 
+lvraster.setBackend(options.rasterBackend)
+tiledBackground = options.tiledBackground
+svgBars = options.svgBars
+lazyPopups = options.lazyPopups
+virtualRows = options.virtualRows
+
+if options.splitTimeline is not None and \
+   options.splitTimeline != "sections" and \
+   (not options.splitTimeline.isdigit() or int(options.splitTimeline) < 1):
+    parser.error('--split-timeline must be "sections" or a number of years')
+
 # generate the new files in a temporary directory for HTTP if-mod-since
 # purposes
 tempDir = mkdtemp(dir=os.path.dirname(options.outputDir))
@@ -1158,6 +2263,10 @@ for section in timelineSections:
                    / section['interval'] * int(params['TIMELINE.intervalsize'])
 totalWidth = startPixel - int(params['TIMELINE.leftmargin'])
 
+# every coordinate lookup from here on out goes through these tables
+buildMonthTables()
+renderContext = buildRenderContext()
+
 # read all the data file items into a list
 try:
     rows = readDataFile(params['TIMELINE.datafile'])
@@ -1169,6 +2278,8 @@ except IOError, ex:
 
 # execute all python template bits in the global namespace
 lvhtml.init(params['TIMELINE.templatefile'])
+if options.minify:
+    lvhtml.minify()
 
 # send off any notifications
 doNotifications()
@@ -1184,6 +2295,33 @@ if params.has_key('TIMELINE.interestfile'):
                             ex.args[1]))
         sys.exit(2)
                                 
+# calculate the geometry of all the bars and subitems
+layoutRows(rows)
+
+# an incremental build keeps track of what each file was generated from next
+# to the output dir.  any other build would leave that out of date.
+buildStateFile = os.path.normpath(options.outputDir) + ".buildstate"
+if options.incremental:
+    hooks = None
+    if params.has_key('TIMELINE.hookfile'):
+        hookFile = open(params['TIMELINE.hookfile'], "rt")
+        hooks = hookFile.read()
+        hookFile.close()
+
+    try:
+        buildState = lvutils.BuildState(
+            buildStateFile, options.outputDir,
+            (__version__, lvraster.backend.__name__, hooks))
+    except IOError, ex:
+        sys.stderr.write("%s: error reading build state %s: %s\n"
+                         % (sys.argv[0], buildStateFile, ex.args[1]))
+        sys.exit(1)
+else:
+    if os.path.isfile(buildStateFile):
+        os.remove(buildStateFile)
+    if os.path.isdir(buildStateFile + "-fragments"):
+        shutil.rmtree(buildStateFile + "-fragments")
+
 # copy over the prototypes of all the non-generated files
 try:
     shutil.rmtree(tempDir) # copytree doesn't like pre-existing dirs
@@ -1215,16 +2353,17 @@ except IOError, ex:
 
 # write out the color swatches used for timeline bars and voting keys
 try:
-    if params.has_key('EVENTBAR.color1'):
-        lvutils.writeColorSwatch(params['EVENTBAR.color1'],
-                                 os.path.join(tempDir, "img-generated",
-                                              "color1.png"))
-    if params.has_key('EVENTBAR.color2'):
-        lvutils.writeColorSwatch(params['EVENTBAR.color2'],
-                                 os.path.join(tempDir, "img-generated",
-                                              "color2.png"))
-
-    if params.has_key('EVENTBAR.nocolor'):
+    for colorNum in (1, 2):
+        color = params.get('EVENTBAR.color%d' % colorNum)
+        swatchName = "img-generated/color%d.png" % colorNum
+        if color is not None and \
+               not reuseOutput(swatchName, tempDir, color):
+            lvutils.writeColorSwatch(color, os.path.join(tempDir, swatchName))
+
+    keyColors = (params.get('EVENTBAR.nocolor'),
+                 params.get('EVENTBAR.yescolor'), renderContext.saturation)
+    if params.has_key('EVENTBAR.nocolor') and \
+           not reuseOutput("img-generated/key1.png", tempDir, keyColors):
         # write yes/no color key
         key1 = sliceMaker.SlicedImage(65,12)
         for i in range(1,13):
@@ -1232,10 +2371,12 @@ try:
                            'lowerColor': params['EVENTBAR.nocolor'],
                            'dividerColor': params['EVENTBAR.nocolor'],
                            'upperColor': params['EVENTBAR.yescolor'],
-                           'saturation': float(params['EVENTBAR.saturation']),
+                           'saturation': renderContext.require('saturation'),
                            'brightness': .5})
         key1.generate(os.path.join(tempDir, "img-generated", "key1.png"))
-        
+
+    if params.has_key('EVENTBAR.nocolor') and \
+           not reuseOutput("img-generated/key2.png", tempDir, keyColors):
         # write interest-data intensity key
         key2 = sliceMaker.SlicedImage(10,10)
         for i in range(1,6):
@@ -1243,7 +2384,7 @@ try:
                            'lowerColor': params['EVENTBAR.nocolor'],
                            'dividerColor': params['EVENTBAR.nocolor'],
                            'upperColor': params['EVENTBAR.yescolor'],
-                           'saturation': float(params['EVENTBAR.saturation']),
+                           'saturation': renderContext.require('saturation'),
                            'brightness': 1.0 - 0.2 * i})
         key2.generate(os.path.join(tempDir, "img-generated", "key2.png"))
             
@@ -1262,6 +2403,20 @@ except IOError, ex:
                      % (sys.argv[0], tempDir, ex.args[1]))
     sys.exit(1)
 
+# work out how the timeline is split into pages, if it is
+if options.splitTimeline is not None:
+    timelinePages = buildTimelinePages(options.splitTimeline, rows)
+
+    # a row is written out again on every page it runs across, so short
+    # pages and long rows can make for far more output than one page would
+    pageRowCount = sum([len(getPageRows(rows, page))
+                        for page in timelinePages])
+    if pageRowCount > 10 * len(rows):
+        sys.stderr.write("%s: warning: splitting the timeline into %d pages "
+                         "writes out its %d rows %d times; try a longer "
+                         "split\n" % (sys.argv[0], len(timelinePages),
+                                      len(rows), pageRowCount))
+
 # write the main HTML page (index.html)
 try:
     writeIndex(tempDir)
@@ -1278,23 +2433,75 @@ except IOError, ex:
                      % (sys.argv[0], tempDir, ex.args[1]))
     sys.exit(1)
 
-# write out the timeline frame
-writeTimelineFrame(rows, tempDir)
+# write out the timeline frame, reusing cached bar images and rendering the
+# rest in parallel, if requested
+if options.imageCache is not None:
+    try:
+        barImageCache = lvutils.ImageCache(
+            options.imageCache, options.imageCacheSize * 1024 * 1024)
+    except os.error, ex:
+        sys.stderr.write("%s: error creating image cache %s: %s\n"
+                         % (sys.argv[0], options.imageCache, ex.args[1]))
+        sys.exit(1)
+if options.jobs > 1:
+    import multiprocessing
+    barImagePool = multiprocessing.Pool(options.jobs)
+assignBarColors(rows)
+if timelinePages is None:
+    writeTimelineFrame(rows, tempDir)
+else:
+    for page in timelinePages:
+        writeTimelineFrame(getPageRows(rows, page), tempDir, page)
+if barImagePool is not None:
+    barImagePool.close()
+    barImagePool.join()
+if barImageCache is not None:
+    barImageCache.prune()
 
 # write out the stylesheets
 try:
-    cssFile = open(os.path.join(tempDir, "styles.css"), "wt")
-    cssFile.write(lvhtml.stylesheets)
-    cssFile.close()
+    if not reuseOutput("styles.css", tempDir,
+                       (tiledBackground,
+                        describeTemplateSymbols('stylesheets',
+                                                'tiledBackgroundStylesheet'))):
+        cssFile = open(os.path.join(tempDir, "styles.css"), "wt")
+        cssFile.write(lvhtml.stylesheets)
+        if tiledBackground:
+            cssFile.write(lvhtml.tiledBackgroundStylesheet)
+        cssFile.close()
 except IOError, ex:
     sys.stderr.write("%s: error writing : %s\n"
                      % (sys.argv[0], os.path.join(tempDir, "styles.css"),
                         ex.args[1]))
     sys.exit(1)
 
+# shrink the generated images
+if options.optimizeImages:
+    try:
+        count, totalBefore, totalAfter = lvpng.optimizeDir(
+            os.path.join(tempDir, "img-generated"))
+    except (IOError, ValueError, zlib.error), ex:
+        sys.stderr.write("%s: error optimizing images: %s\n"
+                         % (sys.argv[0], ex))
+        sys.exit(1)
+
+    if totalBefore > 0:
+        print "optimized %d images: %d bytes -> %d bytes (%.1f%% smaller)" \
+              % (count, totalBefore, totalAfter,
+                 100 * (totalBefore - totalAfter) / totalBefore)
+
 # update the existing tree with any changed files; this way we don't blow out
 # people's browser caches by unnecessarily changing file timestamps.
-lvutils.updateTree(tempDir, options.outputDir)
+lvutils.updateTree(tempDir, options.outputDir, options.gzipSiblings)
 shutil.rmtree(tempDir)
 
+# remember what everything was generated from for the next incremental build
+if buildState is not None:
+    try:
+        buildState.save()
+    except IOError, ex:
+        sys.stderr.write("%s: error writing build state %s: %s\n"
+                         % (sys.argv[0], buildStateFile, ex.args[1]))
+        sys.exit(1)
+
 sys.exit(0)
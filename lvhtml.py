@@ -32,6 +32,8 @@ editing very difficult.  So we isolate the pain to this one file.
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import re
+
 __author__ = "Dan Mosedale and James Home <timeline@list.longnow.org>"
 __version__ = "1.0"
 __copyright__ = "Copyright (c) 2004 The Long Now Foundation"
@@ -50,6 +52,134 @@ def init(filename):
     return
 
 
+# the templates that are CSS rather than HTML
+stylesheetTemplates = ('stylesheets', 'tiledBackgroundStylesheet')
+
+# elements that whitespace next to never shows up beside
+blockElements = ('area', 'body', 'br', 'div', 'frame', 'frameset', 'head',
+                 'html', 'link', 'map', 'meta', 'script', 'table', 'tbody',
+                 'td', 'th', 'thead', 'title', 'tr')
+
+# comments with % slots in them are kept, so the slots still line up
+htmlCommentRE = re.compile(r"<!--(?!\[)[^%]*?-->")
+htmlSpaceRE = re.compile(r"(</?([a-zA-Z]+)[^<>]*>)?(\s+)(?=</?([a-zA-Z]+))?")
+cssCommentRE = re.compile(r"/\*.*?\*/", re.DOTALL)
+cssPartsRE = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')""")
+cssSpaceRE = re.compile(r"\s*([{};,>])\s*|(:)\s+|(\s)\s+")
+cssRuleRE = re.compile(r"([^{}]*)\{([^{}]*)\}")
+cssPixelsRE = re.compile(r"^(-?\d+)(px)?$")
+
+
+def collapseHtmlSpace(match):
+    """Shorten a run of whitespace matched by htmlSpaceRE."""
+
+    tag, before, space, after = match.groups()
+    if tag is None:
+        tag = ""
+
+    # between a tag and a block element the whitespace can go entirely
+    if (before is not None and before.lower() in blockElements) or \
+       (after is not None and after.lower() in blockElements):
+        return tag
+
+    if "\n" in space:
+        return tag + "\n"
+    return tag + " "
+
+
+def collapseCssSpace(match):
+    """Shorten a run of whitespace matched by cssSpaceRE."""
+
+    punctuation, colon, space = match.groups()
+    return punctuation or colon or " "
+
+
+def minifyHtml(html):
+    """Return an HTML template with its comments and excess whitespace taken
+    out.  Nothing else is touched, so its % slots work as before.
+
+    html -- HTML template to minify
+    """
+
+    # whitespace is significant here, so leave these alone
+    if "<pre" in html or "<textarea" in html:
+        return html
+
+    return htmlSpaceRE.sub(collapseHtmlSpace, htmlCommentRE.sub("", html))
+
+
+def minifyCss(css):
+    """Return a stylesheet with its comments and excess whitespace taken out.
+
+    css -- stylesheet to minify
+    """
+
+    # leave anything in quotes as it is
+    parts = cssPartsRE.split(cssCommentRE.sub("", css))
+    for i in range(0, len(parts), 2):
+        parts[i] = cssSpaceRE.sub(collapseCssSpace, parts[i])
+
+    return "".join(parts).replace(";}", "}").strip() + "\n"
+
+
+def getVerticalPadding(css, selector):
+    """Return the (top, bottom) padding in pixels a stylesheet gives to the
+    elements matched by a selector.
+
+    css -- stylesheet to look in
+    selector -- selector to look for, such as ".data"
+
+    Only rules for exactly that selector count, and lengths in anything but
+    pixels are taken as 0.
+    """
+
+    def getPixels(length):
+        match = cssPixelsRE.match(length)
+        if match is None:
+            return 0
+        return int(match.group(1))
+
+    top = bottom = 0
+
+    for selectors, declarations in cssRuleRE.findall(
+            cssCommentRE.sub("", css)):
+        if selector not in [name.strip() for name in selectors.split(",")]:
+            continue
+
+        for declaration in declarations.split(";"):
+            if ":" not in declaration:
+                continue
+            name, value = [part.strip().lower()
+                           for part in declaration.split(":", 1)]
+            if name == "padding-top":
+                top = getPixels(value)
+            elif name == "padding-bottom":
+                bottom = getPixels(value)
+            elif name == "padding":
+                lengths = value.split()
+                top = getPixels(lengths[0])
+                bottom = getPixels(lengths[len(lengths) > 2 and 2 or 0])
+
+    return top, bottom
+
+
+def minify():
+    """Minify all the templates in the lvhtml module global namespace,
+    including any the template file set.
+    """
+
+    namespace = globals()
+    for name, value in namespace.items():
+        if name.startswith("_") or not isinstance(value, str):
+            continue
+        if name in stylesheetTemplates:
+            namespace[name] = minifyCss(value)
+        else:
+            namespace[name] = minifyHtml(value)
+
+    return
+
+
 indexHtml = """<!DOCTYPE html PUBLIC \"-//W3C//DTD XHTML 1.0 Frameset//EN\"
         \"http://www.w3.org/TR/xhtml1/DTD/xhtml1-frameset.dtd\">
 
@@ -104,7 +234,8 @@ headerTop = """<html xmlns="http://www.w3.org/1999/xhtml">
 <td nowrap="nowrap">\n"""
 
 
-def buildnavcell(prefix, dateString, mouseoverImg, mouseoutImg, name):
+def buildnavcell(prefix, dateString, mouseoverImg, mouseoutImg, name,
+                 page="timeline.html"):
     """Build the HTML for a single navcell.
 
     prefix -- the string to tack on to the front of the anchor name
@@ -112,17 +243,18 @@ def buildnavcell(prefix, dateString, mouseoverImg, mouseoutImg, name):
     mouseoverImg -- name of the image to be displayed on mouseover
     mouseoutImg -- name of the image to be displayed on mouseout
     name -- name of this navcell
+    page -- timeline page the anchor is on
     """
 
     return """<a
-href="timeline.html#%s%s"
+href="%s#%s%s"
 target="timeline" 
 onclick="onimgs('%s', '%s', '%s'); return true;"
 onmouseover="chimgs('%s', '%s'); return true;"
 onmouseout="chimgs('%s', '%s'); return true;"><img 
 
 src="%s" alt="" width="25" height="20" border="0" name="%s" /></a>""" \
-     % (prefix, dateString, name, mouseoverImg, mouseoutImg, name,
+     % (page, prefix, dateString, name, mouseoverImg, mouseoutImg, name,
         mouseoverImg, name, mouseoutImg, mouseoutImg, name)
 
 
@@ -165,6 +297,65 @@ timelinePastNowTable = """
 
 timelineBottom = "</body>\n</html>\n"
 
+# written instead of the popups when they're loaded on demand: the popup
+# templates, split up on their escape sequences, and the shard of popups/
+# each node's popup is in
+lazyPopupScript = """<script language="javascript" type="text/javascript">
+var popupTemplates = %s;
+var popupShards = %s;
+</script>\n
+"""
+
+# used instead of the datatable and the labels when the rows are put into
+# the page as they scroll into view: rows.js fills these in from the rows'
+# geometry.  (%d widths and heights in pixels, %s the rows file.)
+virtualRowsTop = """<div id="datatable" style="position: relative; width: %dpx; height: %dpx">\n"""
+
+virtualRowsBottom = "</div>\n"
+
+virtualLabels = """<div id="labels">
+<div id="virtuallabels" style="position: relative; height: %dpx"></div>
+</div>
+<script language="javascript" type="text/javascript" src="./%s"></script>\n
+"""
+
+# used instead of a full-width background image when the background is
+# tiled: the tiles and now box go behind the datatable, which gets wrapped
+# in a div to position them.  (%d widths and offsets in pixels, %s the now
+# bar color.)
+timelineBackgroundTop = """<div id="timelinebg" style="width: %dpx">
+<div id="nowoverlay" style="left: %dpx; width: %dpx; background-color: %s"></div>
+<div id="futureoverlay" style="left: %dpx; width: %dpx"></div>
+"""
+
+timelineBackgroundBottom = "</div>\n"
+
+tiledBackgroundStylesheet = """
+/* the background of the timeline, when it's a repeating tile */
+#timelinebg {
+  position: relative;
+  background-image: url('./img-generated/timeline-bg.png');
+  background-position: 0 1px;
+  }
+
+#datatable {
+  position: relative;
+  z-index: 1;
+  background-image: none;
+  }
+
+/* the now bar and the stippling of the future, over the background */
+#nowoverlay, #futureoverlay {
+  position: absolute;
+  top: 1px;
+  bottom: 0;
+  }
+
+#futureoverlay {
+  background-image: url('./img-generated/timeline-future.png');
+  }
+"""
+
 
 def buildLabel(nodeId, labelText, labelLink):
     """Build a label cell
@@ -201,6 +392,22 @@ generatedBar = """
 <img src="./img/no.gif" width="%d" height="1" alt="" border="0" /><img 
 src="./img-generated/%s.png" width="%d" height="%d" alt="" border="0" usemap="#node%smap" />"""
 
+# bars drawn as inline SVG (see timelineCell and generatedBar).  The area
+# elements of a bar with subitems become invisible shapes on top of it.
+svgTimelineCell = """<img src="img-static/no.gif" width="%d" height="1" alt="" border="0" /><a href="%s" onmouseout="javascript:hideNode('%s')" onmouseover="javascript:showNode('%s')" %sname="node%s" target="_top">%s</a>"""
+
+svgGeneratedBar = """
+<img src="./img/no.gif" width="%d" height="1" alt="" border="0" />%s"""
+
+def buildSvgArea(nodeString, x, y, width, height):
+    """Build an invisible SVG rect that shows a popup on mouseover
+
+    nodeString -- name of node to show/hide
+    x, y, width, height -- position and size of the rect
+    """
+
+    return """<rect x="%d" y="%d" width="%d" height="%d" fill-opacity="0" onmouseout="hideNode('%s')" onmouseover="showNode('%s')" />""" % (x, y, width, height, nodeString, nodeString)
+
 def buildAreaElement(shape, nodeString, x1, y1, x2, y2):
     """Build an AREA element for an imagemap
 
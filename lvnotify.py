@@ -116,17 +116,19 @@ class DefaultNotifier:
         
         # read the data file into memory
         reader = csv.reader(file(self.__filename))
+        rows = list(reader)
+        dates = lvutils.LVDate.parseColumn(rows, 1)
         index = 0
-        for row in reader:
+        for row in rows:
             if len(row) == 5:
                 self.notifications.append(
                     self.notificationClass(eval(row[0]),
-                                           lvutils.LVDate(row[1]), row[2],
+                                           dates[index], row[2],
                                            row[3], row[4], index))
             else:
                 self.notifications.append(
                     self.notificationClass(eval(row[0]),
-                                           lvutils.LVDate(row[1]), row[2],
+                                           dates[index], row[2],
                                            row[3], "Unsent", index))
             index += 1
 
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+"""Lossless optimizer for the palette PNGs that Long View generates.
+
+Each image is rewritten with only the colors it actually uses, in the
+smallest bit depth that will hold them, with whichever combination of
+scanline filters and zlib settings compresses it best.  The pixels
+themselves never change, and an image is only replaced if the result is
+smaller.
+"""
+
+# Copyright (c) 2004, The Long Now Foundation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import absolute_import, division, with_statement
+
+import os
+import struct
+import zlib
+
+from lvraster import pngChunk
+
+__author__ = "Dan Mosedale, James Home, and Ben Keating"
+__maintainer__ = "Ben Keating"
+__email__ = "oss+longview@longnow.org"
+
+__version__ = "1.1"
+__license__ = "BSD-style"
+__status__ = "Beta"
+
+
+pngSignature = "\x89PNG\r\n\x1a\n"
+
+# ancillary chunks that don't affect how an image looks, and so get dropped
+droppedChunks = ("tEXt", "zTXt", "iTXt", "tIME")
+
+# zlib strategies to try compressing with
+zlibStrategies = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED)
+
+# scanline filters to try: each of the five PNG filter types for every row,
+# or (None) the best-looking filter chosen row by row
+filterChoices = (0, 1, 2, 3, 4, None)
+
+
+class PaletteImage:
+    """A decoded palette PNG: one palette index per pixel, row by row."""
+
+    def __init__(self, width, height, palette, alphas, rows, otherChunks):
+        """Initialize a PaletteImage object
+
+        width, height -- size of the image
+        palette -- list of (r, g, b) tuples
+        alphas -- list of alpha values, one per palette entry
+        rows -- list of bytearrays of palette indexes, one per row
+        otherChunks -- list of (type, data) of any other chunks to keep
+        """
+
+        self.width = width
+        self.height = height
+        self.palette = palette
+        self.alphas = alphas
+        self.rows = rows
+        self.otherChunks = otherChunks
+        return
+
+
+def readChunks(data):
+    """Return the (type, data) of every chunk in the PNG data."""
+
+    if not data.startswith(pngSignature):
+        raise ValueError, "not a PNG file"
+
+    chunks = []
+    pos = len(pngSignature)
+    while pos < len(data):
+        length, chunkType = struct.unpack(">I4s", data[pos:pos + 8])
+        chunks.append((chunkType, data[pos + 8:pos + 8 + length]))
+        pos += length + 12
+
+    return chunks
+
+
+def unfilterRows(raw, height, rowBytes, bytesPerPixel):
+    """Undo the scanline filters of decompressed image data.
+
+    Returns a list of bytearrays, one per row.
+    """
+
+    rows = []
+    previous = bytearray(rowBytes)
+    pos = 0
+    for y in range(height):
+        filterType = ord(raw[pos])
+        row = bytearray(raw[pos + 1:pos + 1 + rowBytes])
+        pos += rowBytes + 1
+
+        if filterType == 1:
+            for i in range(bytesPerPixel, rowBytes):
+                row[i] = (row[i] + row[i - bytesPerPixel]) & 0xff
+        elif filterType == 2:
+            for i in range(rowBytes):
+                row[i] = (row[i] + previous[i]) & 0xff
+        elif filterType == 3:
+            for i in range(rowBytes):
+                if i >= bytesPerPixel:
+                    left = row[i - bytesPerPixel]
+                else:
+                    left = 0
+                row[i] = (row[i] + (left + previous[i]) // 2) & 0xff
+        elif filterType == 4:
+            for i in range(rowBytes):
+                if i >= bytesPerPixel:
+                    left = row[i - bytesPerPixel]
+                    upperLeft = previous[i - bytesPerPixel]
+                else:
+                    left = upperLeft = 0
+                row[i] = (row[i] + paeth(left, previous[i], upperLeft)) \
+                         & 0xff
+        elif filterType != 0:
+            raise ValueError, "unknown filter type %d" % filterType
+
+        rows.append(row)
+        previous = row
+
+    return rows
+
+
+def paeth(left, up, upperLeft):
+    """Return the Paeth predictor of a byte."""
+
+    estimate = left + up - upperLeft
+    leftDistance = abs(estimate - left)
+    upDistance = abs(estimate - up)
+    upperLeftDistance = abs(estimate - upperLeft)
+
+    if leftDistance <= upDistance and leftDistance <= upperLeftDistance:
+        return left
+    elif upDistance <= upperLeftDistance:
+        return up
+    return upperLeft
+
+
+def unpackRow(row, width, bitDepth):
+    """Return a bytearray of one palette index per pixel of a packed row."""
+
+    if bitDepth == 8:
+        return row[:width]
+
+    pixelsPerByte = 8 // bitDepth
+    mask = (1 << bitDepth) - 1
+    pixels = bytearray(width)
+    for x in range(width):
+        shift = 8 - bitDepth * (x % pixelsPerByte + 1)
+        pixels[x] = (row[x // pixelsPerByte] >> shift) & mask
+
+    return pixels
+
+
+def packRow(pixels, bitDepth):
+    """Return a row of palette indexes packed into bitDepth bits apiece."""
+
+    if bitDepth == 8:
+        return bytearray(pixels)
+
+    pixelsPerByte = 8 // bitDepth
+    row = bytearray((len(pixels) + pixelsPerByte - 1) // pixelsPerByte)
+    for x in range(len(pixels)):
+        shift = 8 - bitDepth * (x % pixelsPerByte + 1)
+        row[x // pixelsPerByte] |= pixels[x] << shift
+
+    return row
+
+
+def decodePng(data):
+    """Return a PaletteImage, or None if data isn't a palette PNG we handle.
+
+    data -- contents of a PNG file
+    """
+
+    chunks = readChunks(data)
+
+    header = chunks[0][1]
+    width, height, bitDepth, colorType, compression, filterMethod, \
+           interlace = struct.unpack(">IIBBBBB", header)
+    if colorType != 3 or interlace != 0:
+        return None
+
+    palette = []
+    alphas = []
+    compressed = []
+    otherChunks = []
+    for chunkType, chunkData in chunks[1:]:
+        if chunkType == "PLTE":
+            palette = [struct.unpack("BBB", chunkData[i:i + 3])
+                       for i in range(0, len(chunkData), 3)]
+        elif chunkType == "tRNS":
+            alphas = [ord(alpha) for alpha in chunkData]
+        elif chunkType == "IDAT":
+            compressed.append(chunkData)
+        elif chunkType != "IEND" and chunkType not in droppedChunks:
+            otherChunks.append((chunkType, chunkData))
+
+    alphas = alphas + [0xff] * (len(palette) - len(alphas))
+
+    rowBytes = (width * bitDepth + 7) // 8
+    packedRows = unfilterRows(zlib.decompress("".join(compressed)), height,
+                              rowBytes, 1)
+    rows = [unpackRow(row, width, bitDepth) for row in packedRows]
+
+    return PaletteImage(width, height, palette, alphas, rows, otherChunks)
+
+
+def filterRow(filterType, row, previous):
+    """Return row, with filterType applied, preceded by the filter type."""
+
+    filtered = bytearray(len(row) + 1)
+    filtered[0] = filterType
+    for i in range(len(row)):
+        if i >= 1:
+            left = row[i - 1]
+            upperLeft = previous[i - 1]
+        else:
+            left = upperLeft = 0
+
+        if filterType == 0:
+            predictor = 0
+        elif filterType == 1:
+            predictor = left
+        elif filterType == 2:
+            predictor = previous[i]
+        elif filterType == 3:
+            predictor = (left + previous[i]) // 2
+        else:
+            predictor = paeth(left, previous[i], upperLeft)
+        filtered[i + 1] = (row[i] - predictor) & 0xff
+
+    return filtered
+
+
+def filterRows(rows, filterChoice):
+    """Return the scanlines of rows, filtered according to filterChoice.
+
+    filterChoice -- a filter type for every row, or None to pick a filter
+                    for each row: whichever gives the smallest sum of
+                    absolute differences, the usual heuristic.
+    """
+
+    scanlines = []
+    previous = bytearray(len(rows[0]))
+    for row in rows:
+        if filterChoice is not None:
+            scanlines.append(filterRow(filterChoice, row, previous))
+        else:
+            best = None
+            for filterType in range(5):
+                filtered = filterRow(filterType, row, previous)
+                cost = sum([min(value, 256 - value)
+                            for value in filtered[1:]])
+                if best is None or cost < best[0]:
+                    best = (cost, filtered)
+            scanlines.append(best[1])
+        previous = row
+
+    return "".join([str(scanline) for scanline in scanlines])
+
+
+def encodePng(image):
+    """Return the smallest PNG we can make of a PaletteImage."""
+
+    # keep only the colors in use, once each, with any that aren't opaque
+    # first so that the tRNS chunk can stop short
+    used = {}
+    for row in image.rows:
+        for index in set(row):
+            used[index] = True
+    colors = {}
+    for index in used.keys():
+        colors[(image.alphas[index] == 0xff, image.palette[index],
+                image.alphas[index])] = True
+    colors = colors.keys()
+    colors.sort()
+    newIndexes = {}
+    for newIndex in range(len(colors)):
+        newIndexes[colors[newIndex][1:]] = newIndex
+    mapping = bytearray(256)
+    for index in used.keys():
+        mapping[index] = newIndexes[(image.palette[index],
+                                     image.alphas[index])]
+
+    # every PNG palette needs at least one entry
+    if len(colors) == 0:
+        colors = [(True, (0, 0, 0), 0xff)]
+
+    bitDepth = 1
+    while len(colors) > 1 << bitDepth:
+        bitDepth *= 2
+
+    rows = [packRow(row.translate(mapping), bitDepth) for row in image.rows]
+
+    chunks = [pngChunk("IHDR", struct.pack(">IIBBBBB", image.width,
+                                           image.height, bitDepth, 3, 0, 0,
+                                           0)),
+              pngChunk("PLTE", "".join([struct.pack("BBB", *rgb)
+                                        for opaque, rgb, alpha in colors]))]
+    alphas = [alpha for opaque, rgb, alpha in colors if not opaque]
+    if alphas:
+        chunks.append(pngChunk("tRNS", "".join(map(chr, alphas))))
+    for chunkType, chunkData in image.otherChunks:
+        chunks.append(pngChunk(chunkType, chunkData))
+
+    # try every combination of filters and zlib strategies
+    best = None
+    for filterChoice in filterChoices:
+        scanlines = filterRows(rows, filterChoice)
+        for strategy in zlibStrategies:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9,
+                                          strategy)
+            compressed = compressor.compress(scanlines) + compressor.flush()
+            if best is None or len(compressed) < len(best):
+                best = compressed
+
+    chunks.append(pngChunk("IDAT", best))
+    chunks.append(pngChunk("IEND", ""))
+
+    return pngSignature + "".join(chunks)
+
+
+def optimizePng(filename):
+    """Rewrite a PNG file as compactly as possible, if that makes it smaller.
+
+    Returns a (size before, size after) tuple.  Files that aren't palette
+    PNGs are left alone.
+    """
+
+    pngFile = open(filename, "rb")
+    data = pngFile.read()
+    pngFile.close()
+
+    image = decodePng(data)
+    if image is None or image.height == 0:
+        return (len(data), len(data))
+
+    optimized = encodePng(image)
+    if len(optimized) >= len(data):
+        return (len(data), len(data))
+
+    pngFile = open(filename, "wb")
+    pngFile.write(optimized)
+    pngFile.close()
+
+    return (len(data), len(optimized))
+
+
+def optimizeDir(directory):
+    """Optimize every PNG in directory.
+
+    Returns a (number of PNGs, total size before, total size after) tuple.
+    """
+
+    count = 0
+    totalBefore = 0
+    totalAfter = 0
+    for name in os.listdir(directory):
+        if name.lower().endswith(".png"):
+            before, after = optimizePng(os.path.join(directory, name))
+            count += 1
+            totalBefore += before
+            totalAfter += after
+
+    return (count, totalBefore, totalAfter)
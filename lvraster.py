@@ -0,0 +1,678 @@
+#!/usr/bin/env python
+
+"""Pure-Python raster backend for Long View images.
+
+Implements the subset of the gd module's drawing API that Long View uses,
+drawing into a byte buffer and encoding the PNG itself with zlib, so that
+images can be generated on systems where the gd module isn't available.
+The rules for which pixels get drawn follow those of gd 2.0.
+"""
+
+# Copyright (c) 2004, The Long Now Foundation
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from __future__ import absolute_import, division, with_statement
+
+import struct
+import sys
+import zlib
+
+__author__ = "Dan Mosedale, James Home, and Ben Keating"
+__maintainer__ = "Ben Keating"
+__email__ = "oss+longview@longnow.org"
+
+__version__ = "1.1"
+__license__ = "BSD-style"
+__status__ = "Beta"
+
+
+# special "colors", with the same values gd uses
+gdStyled = -2
+gdBrushed = -3
+gdStyledBrushed = -4
+gdTiled = -5
+gdTransparent = -6
+
+# maximum number of colors in a palette image
+maxColors = 256
+
+
+class image:
+    """A palette image, drawn with gd-compatible methods."""
+
+    def __init__(self, size):
+        """Initialize an image object
+
+        size -- (width, height) tuple
+        """
+
+        self.width, self.height = size
+
+        # one palette index per pixel, row by row; new images are filled
+        # with the first color allocated, just like in gd
+        self.pixels = bytearray(self.width * self.height)
+
+        self.palette = []
+        """List of (r, g, b) tuples, indexed by palette index"""
+
+        self.transparent = -1
+        """Palette index of the transparent color, or -1 for none"""
+
+        self.__tile = None
+        self.__tileColorMap = None
+        self.__brush = None
+        self.__brushColorMap = None
+        self.__style = None
+        self.__stylePos = 0
+
+        return
+
+    def size(self):
+        """Return the (width, height) of this image."""
+
+        return (self.width, self.height)
+
+    def colorAllocate(self, rgb):
+        """Add rgb to the palette, returning its index, or -1 if it's full."""
+
+        if len(self.palette) >= maxColors:
+            return -1
+
+        self.palette.append(tuple(rgb))
+        return len(self.palette) - 1
+
+    def colorExact(self, rgb):
+        """Return the index of rgb in the palette, or -1 if it isn't there."""
+
+        rgb = tuple(rgb)
+        if rgb in self.palette:
+            return self.palette.index(rgb)
+        return -1
+
+    def colorClosest(self, rgb):
+        """Return the index of the palette color closest to rgb."""
+
+        closest = -1
+        closestDistance = None
+        for i in range(len(self.palette)):
+            distance = 0
+            for a, b in zip(self.palette[i], rgb):
+                distance += (a - b) * (a - b)
+            if closestDistance is None or distance < closestDistance:
+                closest = i
+                closestDistance = distance
+        return closest
+
+    def colorResolve(self, rgb):
+        """Return the index of rgb, allocating it if it isn't there yet.
+
+        If the palette is full, the closest existing color is used.
+        """
+
+        colorIndex = self.colorExact(rgb)
+        if colorIndex == -1:
+            colorIndex = self.colorAllocate(rgb)
+        if colorIndex == -1:
+            colorIndex = self.colorClosest(rgb)
+        return colorIndex
+
+    def colorTransparent(self, colorIndex):
+        """Make the given palette index transparent."""
+
+        self.transparent = colorIndex
+        return
+
+    def setTile(self, tile):
+        """Use the given image for filling with gdTiled."""
+
+        self.__tile = tile
+        self.__tileColorMap = [self.colorResolve(rgb)
+                               for rgb in tile.palette]
+        return
+
+    def setBrush(self, brush):
+        """Use the given image for drawing with gdBrushed."""
+
+        self.__brush = brush
+        self.__brushColorMap = [self.colorResolve(rgb)
+                                for rgb in brush.palette]
+        return
+
+    def setStyle(self, style):
+        """Use the given sequence of colors for drawing with gdStyled."""
+
+        self.__style = list(style)
+        self.__stylePos = 0
+        return
+
+    def getPixel(self, point):
+        """Return the palette index of the pixel at point."""
+
+        x, y = point
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return 0
+        return self.pixels[y * self.width + x]
+
+    def setPixel(self, point, color):
+        """Set the pixel at point to color (which may be a special color)."""
+
+        x, y = point
+
+        if color == gdStyled:
+            color = self.__style[self.__stylePos]
+            self.__stylePos = (self.__stylePos + 1) % len(self.__style)
+            if color == gdTransparent:
+                return
+
+        elif color == gdBrushed:
+            self.__applyBrush(x, y)
+            return
+
+        elif color == gdTiled:
+            if x < 0 or x >= self.width or y < 0 or y >= self.height:
+                return
+            tile = self.__tile
+            tileColor = tile.pixels[(y % tile.height) * tile.width
+                                    + x % tile.width]
+            if tileColor == tile.transparent:
+                return
+            color = self.__tileColorMap[tileColor]
+
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return
+        self.pixels[y * self.width + x] = color
+        return
+
+    def filledRectangle(self, topLeft, bottomRight, color):
+        """Fill the rectangle between the given corners (inclusive)."""
+
+        x1, y1 = topLeft
+        x2, y2 = bottomRight
+
+        # like gd, clip only the starting corner; a rectangle whose corners
+        # are the wrong way around draws nothing
+        x1 = min(max(x1, 0), self.width)
+        y1 = min(max(y1, 0), self.height)
+        x2 = min(x2, self.width - 1)
+        y2 = min(y2, self.height - 1)
+        if x2 < x1 or y2 < y1:
+            return
+
+        if color >= 0:
+            run = bytearray((color,)) * (x2 - x1 + 1)
+            for y in range(y1, y2 + 1):
+                self.pixels[y * self.width + x1:y * self.width + x2 + 1] = run
+
+        elif color == gdTiled:
+            # fill each column of the tile that isn't transparent in one go
+            tile = self.__tile
+            for y in range(y1, y2 + 1):
+                tileRow = (y % tile.height) * tile.width
+                for tileX in range(tile.width):
+                    tileColor = tile.pixels[tileRow + tileX]
+                    if tileColor == tile.transparent:
+                        continue
+                    firstX = x1 + (tileX - x1) % tile.width
+                    if firstX > x2:
+                        continue
+                    count = (x2 - firstX) // tile.width + 1
+                    start = y * self.width + firstX
+                    self.pixels[start:start + (count - 1) * tile.width + 1:
+                                tile.width] = \
+                        bytearray((self.__tileColorMap[tileColor],)) * count
+
+        else:
+            for y in range(y1, y2 + 1):
+                for x in range(x1, x2 + 1):
+                    self.setPixel((x, y), color)
+        return
+
+    def rectangle(self, topLeft, bottomRight, color):
+        """Draw the outline of the rectangle between the given corners."""
+
+        x1, y1 = topLeft
+        x2, y2 = bottomRight
+
+        self.line((x1, y1), (x2, y1), color)
+        self.line((x1, y2), (x2, y2), color)
+        self.line((x1, y1 + 1), (x1, y2 - 1), color)
+        self.line((x2, y1 + 1), (x2, y2 - 1), color)
+        return
+
+    def line(self, start, end, color):
+        """Draw a one pixel wide line between the given points (inclusive)."""
+
+        x1, y1 = start
+        x2, y2 = end
+
+        # the common, axis-aligned cases
+        if y1 == y2:
+            step = x2 >= x1 and 1 or -1
+            for x in range(x1, x2 + step, step):
+                self.setPixel((x, y1), color)
+            return
+
+        if x1 == x2:
+            step = y2 >= y1 and 1 or -1
+            for y in range(y1, y2 + step, step):
+                self.setPixel((x1, y), color)
+            return
+
+        # Bresenham's algorithm for everything else
+        dx = abs(x2 - x1)
+        dy = abs(y2 - y1)
+        xStep = x2 > x1 and 1 or -1
+        yStep = y2 > y1 and 1 or -1
+        error = dx - dy
+        x, y = x1, y1
+        while True:
+            self.setPixel((x, y), color)
+            if x == x2 and y == y2:
+                break
+            doubledError = 2 * error
+            if doubledError > -dy:
+                error -= dy
+                x += xStep
+            if doubledError < dx:
+                error += dx
+                y += yStep
+        return
+
+    def filledPolygon(self, points, color):
+        """Fill the polygon with the given vertices, the same way gd does."""
+
+        for y, x1, x2 in getPolygonSpans(points):
+            self.line((x1, y), (x2, y), color)
+        return
+
+    def fillToBorder(self, point, border, color):
+        """Flood fill outward from point, up to pixels of the border color.
+
+        Like gd, the row through each seed point is filled all the way
+        between borders, and the rows above and below are seeded only from
+        pixels which aren't already the border or fill color.
+        """
+
+        if border < 0:
+            return
+
+        pending = [point]
+        while pending:
+            x, y = pending.pop()
+            row = y * self.width
+
+            # fill leftwards, then rightwards
+            leftLimit = -1
+            for i in range(x, -1, -1):
+                if self.pixels[row + i] == border:
+                    break
+                self.pixels[row + i] = color
+                leftLimit = i
+            if leftLimit == -1:
+                continue
+
+            rightLimit = x
+            for i in range(x + 1, self.width):
+                if self.pixels[row + i] == border:
+                    break
+                self.pixels[row + i] = color
+                rightLimit = i
+
+            # seed the rows above and below once per run of fillable pixels
+            for neighbourY in (y - 1, y + 1):
+                if neighbourY < 0 or neighbourY >= self.height:
+                    continue
+                neighbourRow = neighbourY * self.width
+                lastBorder = True
+                for i in range(leftLimit, rightLimit + 1):
+                    pixel = self.pixels[neighbourRow + i]
+                    if lastBorder:
+                        if pixel != border and pixel != color:
+                            pending.append((i, neighbourY))
+                            lastBorder = False
+                    elif pixel == border or pixel == color:
+                        lastBorder = True
+        return
+
+    def getRow(self, y):
+        """Return row y of the image as a buffer of palette indexes."""
+
+        return buffer(self.pixels, y * self.width, self.width)
+
+    def writePng(self, outputFile):
+        """Write this image to outputFile as a PNG."""
+
+        writer = PngWriter(outputFile, self.width, self.height, self.palette,
+                           self.transparent)
+        for y in range(self.height):
+            writer.writeRow(self.getRow(y))
+        writer.close()
+        return
+
+    def __applyBrush(self, x, y):
+        """Stamp the brush, centered at (x, y)."""
+
+        brush = self.__brush
+        left = x - brush.width // 2
+        top = y - brush.height // 2
+        for brushY in range(brush.height):
+            for brushX in range(brush.width):
+                brushColor = brush.pixels[brushY * brush.width + brushX]
+                if brushColor != brush.transparent:
+                    self.setPixel((left + brushX, top + brushY),
+                                  self.__brushColorMap[brushColor])
+        return
+
+
+def getPolygonSpans(points):
+    """Return the (y, x1, x2) horizontal spans that gd fills a polygon with.
+
+    points -- list of (x, y) vertices
+    """
+
+    if len(points) < 2:
+        return []
+
+    ys = [y for x, y in points]
+    minY = min(ys)
+    maxY = max(ys)
+
+    spans = []
+    for y in range(minY, maxY + 1):
+
+        # find where each edge crosses this scanline, counting each
+        # vertex only once
+        crossings = []
+        for i in range(len(points)):
+            ax, ay = points[i - 1]
+            bx, by = points[i]
+            if ay < by:
+                x1, y1, x2, y2 = ax, ay, bx, by
+            elif ay > by:
+                x1, y1, x2, y2 = bx, by, ax, ay
+            else:
+                continue
+
+            if (y >= y1 and y < y2) or (y == maxY and y > y1 and y <= y2):
+                crossings.append(
+                    int((y - y1) * (x2 - x1) / (y2 - y1) + 0.5 + x1))
+
+        crossings.sort()
+        for i in range(0, len(crossings) - 1, 2):
+            spans.append((y, crossings[i], crossings[i + 1]))
+
+    return spans
+
+
+class svgImage:
+    """An image that records SVG shapes rather than pixels.
+
+    Supports the drawing calls SlicedImage makes (solid colors only), with
+    the same rules for which pixels get covered as image, so the SVG looks
+    the same as the PNG would.
+    """
+
+    def __init__(self, size):
+        """Initialize an svgImage object
+
+        size -- (width, height) tuple
+        """
+
+        self.width, self.height = size
+
+        self.palette = []
+        """List of (r, g, b) tuples, indexed by palette index"""
+
+        self.shapes = []
+        """SVG elements drawn so far, in drawing order"""
+
+        return
+
+    def size(self):
+        """Return the (width, height) of this image."""
+
+        return (self.width, self.height)
+
+    def colorAllocate(self, rgb):
+        """Add rgb to the palette, returning its index."""
+
+        self.palette.append(tuple(rgb))
+        return len(self.palette) - 1
+
+    def colorClosest(self, rgb):
+        """Return the index of rgb, which is always allocated exactly."""
+
+        return self.colorAllocate(rgb)
+
+    def filledRectangle(self, topLeft, bottomRight, color):
+        """Fill the rectangle between the given corners (inclusive)."""
+
+        x1, y1 = topLeft
+        x2, y2 = bottomRight
+
+        # clip just the way image does
+        x1 = min(max(x1, 0), self.width)
+        y1 = min(max(y1, 0), self.height)
+        x2 = min(x2, self.width - 1)
+        y2 = min(y2, self.height - 1)
+        if x2 < x1 or y2 < y1:
+            return
+
+        self.shapes.append('<rect x="%d" y="%d" width="%d" height="%d" '
+                           'fill="#%02x%02x%02x" />'
+                           % ((x1, y1, x2 - x1 + 1, y2 - y1 + 1)
+                              + self.palette[color]))
+        return
+
+    def line(self, start, end, color):
+        """Draw a horizontal or vertical line."""
+
+        (x1, y1), (x2, y2) = start, end
+        if x1 != x2 and y1 != y2:
+            raise ValueError, "only horizontal and vertical lines supported"
+
+        self.filledRectangle((max(min(x1, x2), 0), max(min(y1, y2), 0)),
+                             (max(x1, x2), max(y1, y2)), color)
+        return
+
+    def filledPolygon(self, points, color):
+        """Fill the polygon with the given vertices, the same way gd does."""
+
+        for y, x1, x2 in getPolygonSpans(points):
+            self.line((x1, y), (x2, y), color)
+        return
+
+    def getSvg(self, extra=""):
+        """Return the image as an <svg> element.
+
+        extra -- any more SVG to put on top of the image
+        """
+
+        # like a gd image, the background is the first color allocated
+        shapes = self.shapes
+        if len(self.palette) > 0:
+            shapes = ['<rect width="%d" height="%d" fill="#%02x%02x%02x" />'
+                      % ((self.width, self.height) + self.palette[0])] \
+                      + shapes
+
+        return '<svg xmlns="http://www.w3.org/2000/svg" width="%d" ' \
+               'height="%d" shape-rendering="crispEdges">%s%s</svg>' \
+               % (self.width, self.height, "".join(shapes), extra)
+
+
+class PngWriter:
+    """Writes a palette PNG, with 8 bits per pixel, one scanline at a time.
+
+    Scanlines are compressed as they are written, and the compressed data
+    is written out every chunkSize bytes, so memory use doesn't grow with
+    the size of the image.
+    """
+
+    chunkSize = 65536
+    """Maximum number of compressed bytes to hold before writing them out"""
+
+    def __init__(self, outputFile, width, height, palette, transparent):
+        """Initialize a PngWriter object, writing out the PNG header
+
+        outputFile -- file to write the PNG to
+        width, height -- size of the image
+        palette -- list of (r, g, b) tuples
+        transparent -- palette index of the transparent color, or -1 for none
+        """
+
+        self.outputFile = outputFile
+        self.width = width
+
+        self.__rowsLeft = height
+        self.__compressor = zlib.compressobj(9)
+        self.__compressed = []
+        self.__compressedSize = 0
+
+        # every PNG palette needs at least one entry
+        if len(palette) == 0:
+            palette = [(0, 0, 0)]
+
+        plte = "".join([struct.pack("BBB", *rgb) for rgb in palette])
+
+        outputFile.write("\x89PNG\r\n\x1a\n")
+        outputFile.write(pngChunk("IHDR", struct.pack(">IIBBBBB", width,
+                                                      height, 8, 3, 0, 0, 0)))
+        outputFile.write(pngChunk("PLTE", plte))
+        if transparent >= 0:
+            outputFile.write(pngChunk("tRNS", "\xff" * transparent + "\x00"))
+
+        return
+
+    def writeRow(self, row):
+        """Write the next scanline.
+
+        row -- string or buffer of one palette index per pixel
+        """
+
+        if len(row) != self.width:
+            raise ValueError, "row is %d pixels wide, not %d" % (len(row),
+                                                                self.width)
+        if self.__rowsLeft == 0:
+            raise ValueError, "all rows of the image have been written"
+
+        # each scanline is preceded by its filter type, which is always 0
+        # (none)
+        self.__addCompressed(self.__compressor.compress("\x00"))
+        self.__addCompressed(self.__compressor.compress(row))
+        self.__rowsLeft -= 1
+
+        return
+
+    def close(self):
+        """Finish writing the PNG; every row must have been written."""
+
+        if self.__rowsLeft != 0:
+            raise ValueError, "%d rows of the image were never written" \
+                  % self.__rowsLeft
+
+        self.__addCompressed(self.__compressor.flush())
+        self.__writeCompressed()
+        self.outputFile.write(pngChunk("IEND", ""))
+
+        return
+
+    def __addCompressed(self, data):
+        """Hold on to compressed data, writing it out once there's enough."""
+
+        if data:
+            self.__compressed.append(data)
+            self.__compressedSize += len(data)
+            if self.__compressedSize >= self.chunkSize:
+                self.__writeCompressed()
+        return
+
+    def __writeCompressed(self):
+        """Write out the compressed data held so far as an IDAT chunk."""
+
+        if self.__compressedSize > 0:
+            self.outputFile.write(pngChunk("IDAT",
+                                           "".join(self.__compressed)))
+            self.__compressed = []
+            self.__compressedSize = 0
+        return
+
+
+def writeRows(img, outputFile, rows, transparent):
+    """Write a PNG made of rows of img, each of which may be used many times.
+
+    img -- image, drawn with any backend
+    outputFile -- file to write the PNG to
+    rows -- row numbers of img, one for each row of the PNG
+    transparent -- palette index of the transparent color, or -1 for none
+    """
+
+    width, height = img.size()
+
+    if isinstance(img, image):
+        palette = img.palette
+        getRow = img.getRow
+    else:
+        palette = [img.colorComponents(i) for i in range(img.colorsTotal())]
+        def getRow(y):
+            return str(bytearray([img.getPixel((x, y))
+                                  for x in range(width)]))
+
+    writer = PngWriter(outputFile, width, len(rows), palette, transparent)
+    rowCache = {}
+    for y in rows:
+        if not rowCache.has_key(y):
+            rowCache[y] = getRow(y)
+        writer.writeRow(rowCache[y])
+    writer.close()
+
+    return
+
+
+def pngChunk(chunkType, data):
+    """Return a PNG chunk of the given type containing data."""
+
+    return struct.pack(">I", len(data)) + chunkType + data \
+           + struct.pack(">I", zlib.crc32(chunkType + data) & 0xffffffff)
+
+
+backends = {'python': sys.modules[__name__]}
+"""Available raster backends, keyed by name"""
+
+try:
+    import gd
+    backends['gd'] = gd
+except ImportError:
+    pass
+
+backend = backends.get('gd', backends['python'])
+"""Module that images are drawn with.  Defaults to gd, if it's installed."""
+
+
+def setBackend(name):
+    """Draw all images with the named backend ("gd" or "python")."""
+
+    global backend
+    backend = backends[name]
+    return
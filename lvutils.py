@@ -29,13 +29,16 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import gzip
+import hashlib
 import os
 import re
 import shutil
+import tempfile
 
 from filecmp import dircmp
 
-import gd
+import lvraster
 
 __author__ = "Dan Mosedale, James Home, and Ben Keating"
 __maintainer__ = "Ben Keating"
@@ -82,7 +85,7 @@ class NowCellPNG:
     def generate(self):
         """Build and write the PNG file"""
 
-        img = gd.image((self.width, self.height))
+        img = lvraster.backend.image((self.width, self.height))
 
         # allocate the background as "white", but set it to be transparent
         bgColorIndex = img.colorAllocate(self.backgroundColor)
@@ -90,7 +93,7 @@ class NowCellPNG:
         img.colorTransparent(bgColorIndex)
 
         # set up the stipple pattern
-        stipple = gd.image((2,2))
+        stipple = lvraster.backend.image((2,2))
         stippleBgColorIndex = stipple.colorAllocate(self.backgroundColor)
         stippleFgColorIndex = stipple.colorAllocate(self.stippleColor)
         stipple.colorTransparent(stippleBgColorIndex)
@@ -99,7 +102,8 @@ class NowCellPNG:
 
         # draw the stippled background
         img.setTile(stipple)
-        img.filledRectangle((1,1), (self.width-2, self.height-2), gd.gdTiled)
+        img.filledRectangle((1,1), (self.width-2, self.height-2),
+                            lvraster.backend.gdTiled)
 
         # draw the now box
         nowBoxColorIndex = img.colorAllocate(self.nowBoxColor)
@@ -123,8 +127,46 @@ class NowCellPNG:
         return
 
     
-def updateTree(srcdir, destdir):
-    """Update destdir with any changes made to srcdir"""
+# extensions of the output files that are worth serving compressed
+compressibleExtensions = (".html", ".css", ".js", ".json", ".svg", ".txt")
+
+
+def isCompressible(filename):
+    """Is filename a kind of file that's worth serving compressed?"""
+
+    return os.path.splitext(filename)[1].lower() in compressibleExtensions
+
+
+def writeGzipSibling(filename):
+    """Write a copy of filename compressed as tightly as gzip can, as
+    filename.gz, for a web server to send to clients that accept it.
+    """
+
+    (fd, tempPath) = tempfile.mkstemp(dir=os.path.dirname(filename))
+    tempFile = os.fdopen(fd, "wb")
+    try:
+        # leave out the name and time, so the same file compresses the same
+        gzipFile = gzip.GzipFile("", "wb", 9, tempFile, 0)
+        sourceFile = open(filename, "rb")
+        shutil.copyfileobj(sourceFile, gzipFile)
+        sourceFile.close()
+        gzipFile.close()
+    finally:
+        tempFile.close()
+
+    os.chmod(tempPath, 0644)
+    os.rename(tempPath, filename + ".gz")
+    return
+
+
+def updateTree(srcdir, destdir, gzipSiblings=False):
+    """Update destdir with any changes made to srcdir
+
+    srcdir -- directory of new files
+    destdir -- directory to update
+    gzipSiblings -- keep a .gz copy of each compressible file in destdir,
+                    rewritten only when the file itself changes
+    """
 
     if not os.path.isdir(destdir):
         os.mkdir(destdir, 0755)
@@ -135,25 +177,44 @@ def updateTree(srcdir, destdir):
     for file in comparison.diff_files:
         shutil.copyfile(os.path.join(srcdir, file),
                         os.path.join(destdir, file))
+        if gzipSiblings and isCompressible(file):
+            writeGzipSibling(os.path.join(destdir, file))
+
+    # unchanged files only need a .gz copy if they're missing one
+    if gzipSiblings:
+        for file in comparison.same_files:
+            if isCompressible(file) and \
+               not os.path.isfile(os.path.join(destdir, file + ".gz")):
+                writeGzipSibling(os.path.join(destdir, file))
 
     # recurse on any common directories
     for directory in comparison.common_dirs:
         if directory == "CVS":
             continue
         updateTree(os.path.join(srcdir, directory),
-                   os.path.join(destdir, directory))
+                   os.path.join(destdir, directory), gzipSiblings)
 
     # copy over anything that's in the src directory only
     for entry in comparison.left_only:
         if os.path.isdir(os.path.join(srcdir, entry)):
-            shutil.copytree(os.path.join(srcdir, entry),
-                            os.path.join(destdir, entry))
+            if gzipSiblings:
+                updateTree(os.path.join(srcdir, entry),
+                           os.path.join(destdir, entry), gzipSiblings)
+            else:
+                shutil.copytree(os.path.join(srcdir, entry),
+                                os.path.join(destdir, entry))
         else:
             shutil.copyfile(os.path.join(srcdir, entry),
                             os.path.join(destdir, entry))
+            if gzipSiblings and isCompressible(entry):
+                writeGzipSibling(os.path.join(destdir, entry))
 
     # get rid of anything that's no longer in the src tree
     for entry in comparison.right_only:
+        if gzipSiblings and entry.endswith(".gz") and \
+           isCompressible(entry[:-3]) and \
+           os.path.isfile(os.path.join(srcdir, entry[:-3])):
+            continue
         if os.path.isdir(os.path.join(destdir, entry)):
             shutil.rmtree(os.path.join(destdir, entry))
         else:
@@ -161,6 +222,319 @@ def updateTree(srcdir, destdir):
     return
 
 
+class ChunkedWriter:
+    """Collects small pieces of text and writes them to a file in chunks.
+
+    Pieces are held in a list until about chunkSize characters of them
+    have built up, then joined and written all at once, so a large page
+    built from many small fragments takes few writes and bounded memory.
+    """
+
+    chunkSize = 262144
+
+    def __init__(self, fileObject, chunkSize=None):
+        """Initialize a ChunkedWriter object
+
+        fileObject -- file object to write the chunks to
+        chunkSize -- characters to collect before writing, if not the default
+        """
+
+        self.fileObject = fileObject
+        if chunkSize is not None:
+            self.chunkSize = chunkSize
+
+        self.pieces = []
+        self.length = 0
+
+        return
+
+    def write(self, text):
+        """Add a piece of text to the output."""
+
+        self.pieces.append(text)
+        self.length += len(text)
+        if self.length >= self.chunkSize:
+            self.flush()
+
+        return
+
+    def writelines(self, pieces):
+        """Add each piece of text from a sequence or generator."""
+
+        for text in pieces:
+            self.pieces.append(text)
+            self.length += len(text)
+            if self.length >= self.chunkSize:
+                self.flush()
+
+        return
+
+    def flush(self):
+        """Write out everything collected so far."""
+
+        if self.pieces:
+            self.fileObject.write("".join(self.pieces))
+            self.pieces = []
+            self.length = 0
+
+        return
+
+    def close(self):
+        """Write out everything collected so far and close the file."""
+
+        self.flush()
+        self.fileObject.close()
+
+        return
+
+
+class ImageCache:
+    """A directory of previously generated images, keyed by their contents.
+
+    Each image is stored under a hash of a description of everything that
+    went into drawing it, so an image whose description hasn't changed
+    since an earlier run can be copied from the cache instead of redrawn.
+    Once the cache grows past its maximum size, prune() removes the least
+    recently used images.
+    """
+
+    version = 1
+    """Bump this whenever the way images are drawn changes."""
+
+    def __init__(self, directory, maxBytes):
+        """Initialize an ImageCache object
+
+        directory -- where to keep the cached images; created if necessary
+        maxBytes -- maximum total size of the cached images
+        """
+
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        return
+
+    def getPath(self, description):
+        """Return the cache pathname for an image with this description."""
+
+        digest = hashlib.sha1("%d:%s:%s" % (self.version,
+                                            lvraster.backend.__name__,
+                                            description)).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".png")
+
+    def fetch(self, description, filename):
+        """Copy a cached image to filename, returning False if there isn't one.
+
+        description -- string describing the image (see getPath())
+        filename -- file to write the image to
+        """
+
+        path = self.getPath(description)
+        if not os.path.isfile(path):
+            return False
+
+        shutil.copyfile(path, filename)
+
+        # the modification time marks when the image was last used
+        os.utime(path, None)
+        return True
+
+    def store(self, description, filename):
+        """Add the image in filename to the cache.
+
+        description -- string describing the image (see getPath())
+        filename -- file the image was written to
+        """
+
+        path = self.getPath(description)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.mkdir(os.path.dirname(path))
+            except os.error:
+                # another process may have just created it
+                pass
+
+        # write to a temporary file first so that nothing ever sees a
+        # partially written image, even with several processes at work
+        tempFile, tempName = tempfile.mkstemp(".tmp", "image",
+                                              os.path.dirname(path))
+        os.close(tempFile)
+        shutil.copyfile(filename, tempName)
+        os.rename(tempName, path)
+
+        return
+
+    def prune(self):
+        """Remove least recently used images until the cache fits maxBytes."""
+
+        entries = []
+        totalBytes = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                info = os.stat(path)
+                entries.append((info.st_mtime, info.st_size, path))
+                totalBytes += info.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(path)
+            totalBytes -= size
+
+        return
+
+
+class BuildState:
+    """What each generated file was built from, kept between runs.
+
+    The state file maps the name of each generated file (relative to the
+    output directory) to a digest of everything that went into it, so that
+    a later run can copy any file whose inputs haven't changed from the
+    previous output instead of generating it again.  Pieces of output that
+    are worth keeping on their own are saved as fragments, in a directory
+    named after the state file.
+    """
+
+    version = 1
+    """Bump this whenever the way any file is generated changes."""
+
+    def __init__(self, filename, previousDir, commonDependencies):
+        """Initialize a BuildState object, reading the previous state if any
+
+        filename -- file the state is kept in
+        previousDir -- output directory of the previous run
+        commonDependencies -- anything that every generated file depends on
+        """
+
+        self.filename = filename
+        self.previousDir = previousDir
+        self.commonDependencies = repr(commonDependencies)
+
+        self.previousDigests = {}
+        """Digests recorded by the previous run, keyed by file name"""
+
+        self.digests = {}
+        """Digests of the files generated by this run, keyed by file name"""
+
+        self.fragmentDir = filename + "-fragments"
+        """Directory that fragments are saved in"""
+
+        self.fragmentsUsed = {}
+        """Names of the fragments this run has used or saved; save() deletes
+        the rest"""
+
+        if os.path.isfile(filename):
+            stateFile = open(filename, "rt")
+            for line in stateFile:
+                digest, name = line.rstrip("\n").split(" ", 1)
+                self.previousDigests[name] = digest
+            stateFile.close()
+
+        return
+
+    def getDigest(self, dependencies):
+        """Return a digest of dependencies and everything's dependencies."""
+
+        return hashlib.sha1("%d:%s:%s" % (self.version,
+                                          self.commonDependencies,
+                                          repr(dependencies))).hexdigest()
+
+    def getFragment(self, name, dependencies):
+        """Return a saved fragment, or None if its dependencies changed.
+
+        name -- name the fragment was saved under
+        dependencies -- anything with a repr() describing what it depends on
+        """
+
+        self.fragmentsUsed[name] = True
+
+        fragmentFile = os.path.join(self.fragmentDir, name)
+        if not os.path.isfile(fragmentFile):
+            return None
+
+        fragment = open(fragmentFile, "rt").read()
+        digest, text = fragment.split("\n", 1)
+        if digest != self.getDigest(dependencies):
+            return None
+
+        return text
+
+    def saveFragment(self, name, dependencies, text):
+        """Save a fragment of output for later builds.
+
+        name -- name to save the fragment under
+        dependencies -- anything with a repr() describing what it depends on
+        text -- the fragment itself
+        """
+
+        self.fragmentsUsed[name] = True
+
+        if not os.path.isdir(self.fragmentDir):
+            os.mkdir(self.fragmentDir)
+
+        fragmentFile = open(os.path.join(self.fragmentDir, name), "wt")
+        fragmentFile.write(self.getDigest(dependencies) + "\n" + text)
+        fragmentFile.close()
+
+        return
+
+    def keepFragment(self, name):
+        """Keep a saved fragment that this run didn't need to look at.
+
+        name -- name the fragment was saved under
+        """
+
+        self.fragmentsUsed[name] = True
+        return
+
+    def reuse(self, name, outputDir, dependencies):
+        """Copy name from the previous output if its dependencies are the same.
+
+        name -- file name, relative to the output directory
+        outputDir -- directory the current run is writing to
+        dependencies -- anything with a repr() describing what name depends on
+
+        Returns True if the file was copied, or False if it needs to be
+        generated.
+        """
+
+        digest = self.getDigest(dependencies)
+        self.digests[name] = digest
+
+        previousFile = os.path.join(self.previousDir, name)
+        if self.previousDigests.get(name) != digest or \
+               not os.path.isfile(previousFile):
+            return False
+
+        shutil.copyfile(previousFile, os.path.join(outputDir, name))
+        return True
+
+    def save(self):
+        """Write out the state of the current run, and delete any fragments
+        it had no use for.
+        """
+
+        names = self.digests.keys()
+        names.sort()
+
+        stateFile = open(self.filename + ".tmp", "wt")
+        for name in names:
+            stateFile.write("%s %s\n" % (self.digests[name], name))
+        stateFile.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+        if os.path.isdir(self.fragmentDir):
+            for name in os.listdir(self.fragmentDir):
+                if not self.fragmentsUsed.has_key(name):
+                    os.remove(os.path.join(self.fragmentDir, name))
+
+        return
+
+
 def writeColorSwatch(color, filename):
     """Write a 1x1 png of the given color.
 
@@ -168,7 +542,7 @@ def writeColorSwatch(color, filename):
     filename -- name of the PNG file
     """
 
-    image = gd.image((1,1))
+    image = lvraster.backend.image((1,1))
 
     # all we have to do is allocate the background color; no need to draw
     # anything in the foreground
@@ -188,8 +562,30 @@ alwaysPrint5DigitYears = True
 dateResolutionDefaultsToYears = True
 """Assume that dates are to be displayed in years?"""
 
+dateParseRE = re.compile(
+    """(?P<year>\d+)?                # year (years if a duration)
+    (/(?P<month>\d+))?               # month (months if a duration)
+    (?P<isBCE>\s?B\.?C\.?E?\.?)?     # is this BCE?
+    """, re.I | re.X)
+"""Pattern that date strings are parsed with"""
+
+dateCacheSize = 4096
+"""Maximum number of date strings to remember the parsed value of"""
+
+dateCache = {}
+"""Number of months represented by recently parsed date strings"""
+
 class LVDate(int):
-    """A date (at month resolution) on a timeline"""
+    """A date (at month resolution) on a timeline
+
+    LVDates carry no per-instance attributes, so code that works through
+    lots of dates can stick to plain integers (see formatDate()).
+    """
+
+    __slots__ = ()
+
+    ongoing = False
+    """Is this really "now, and continuing"?  (see OngoingLVDate)"""
 
     # __new__ is used instead of __init__ because we are overriding a builtin
     # type.  http://www.python.org/2.2.1/descrintro.html#__new__ has details.
@@ -198,16 +594,27 @@ class LVDate(int):
 
         # construct from a raw integer or another lvdate
         if issubclass(date.__class__, int):
-            return int.__new__(LVDate, date)
+            return int.__new__(className, date)
+
+        # assume we've got a string; the same ones tend to come up over and
+        # over again, so remember what they parsed to
+        months = dateCache.get(date)
+        if months is None:
+            months = LVDate.parse(date)
+            if len(dateCache) >= dateCacheSize:
+                dateCache.clear()
+            dateCache[date] = months
+            
+        return int.__new__(className, months)
 
-        # assume we've got a string, and parse it into a single integer
-        # representing either an absolute date or a duration in months
-        parseRE = re.compile(
-            """(?P<year>\d+)?                # year (years if a duration)
-            (/(?P<month>\d+))?               # month (months if a duration)
-            (?P<isBCE>\s?B\.?C\.?E?\.?)?     # is this BCE?
-            """, re.I | re.X)
-        parseMatch = parseRE.match(date)
+    @staticmethod
+    def parse(date):
+        """Return the number of months represented by the string date.
+
+        This is either an absolute date or a duration in months.
+        """
+
+        parseMatch = dateParseRE.match(date)
 
         months = 0
         if parseMatch.group('year'):
@@ -218,8 +625,33 @@ class LVDate(int):
 
         if parseMatch.group('isBCE'):
             months *= -1
-            
-        return int.__new__(LVDate, months)
+
+        return months
+
+    @classmethod
+    def parseColumn(className, rows, column):
+        """Return a list of the dates in one column of a list of CSV rows.
+
+        rows -- list of rows, each a list of strings
+        column -- index of the column to parse
+
+        Each distinct string is only parsed once, however many times it
+        appears in the column.
+        """
+
+        monthsByString = {}
+        dates = []
+        for row in rows:
+            date = row[column]
+            months = monthsByString.get(date)
+            if months is None:
+                months = dateCache.get(date)
+                if months is None:
+                    months = className.parse(date)
+                monthsByString[date] = months
+            dates.append(int.__new__(className, months))
+
+        return dates
 
     # workaround for python 2.3.3 bug/feature (apparently guido says this
     # is not a bug).  without this hack, <class LVDate> + <class LVDate>
@@ -237,47 +669,70 @@ class LVDate(int):
                  monthSeparator="/"):
         """Return a human-readable string representation of this date.
 
-        spaceBeforeBC -- should there be a space between the number and the BC?
-           defaults to False
-        periods -- should BC have periods after the letters?
-           defaults to False
-        resolutionInYears -- should we print this as years only?
-           defaults to the value of dateResolutionDefaultsToYears
-        monthSeperator -- string to use to separate years from months
-           defaults to "/"
+        The arguments are the same as for formatDate().
         """
 
-        yearNum = self/12
-
-        # if the ongoing attribute ongoing is set to True, print this as ?
-        if hasattr(self, "ongoing") and self.ongoing:
+        # if this is an ongoing date, print it as ?
+        if self.ongoing:
             return "?"
-        
-        if abs(yearNum) == yearNum:
-            bc = ""
-            space = ""
-        else:
-            if periods:
-                bc = "B.C."
-            else:
-                bc = "BC"
 
-            if spaceBeforeBC:
-                space = " "
-            else:
-                space = ""
+        return formatDate(self, spaceBeforeBC, periods, resolutionInYears,
+                          monthSeparator)
+
+
+class OngoingLVDate(LVDate):
+    """A date that is really "now, and continuing", and prints as "?"."""
+
+    __slots__ = ()
+
+    ongoing = True
+
+
+def formatDate(months, spaceBeforeBC=False, periods=False,
+               resolutionInYears=None, monthSeparator="/"):
+    """Return a human-readable string representation of a date.
 
-        if alwaysPrint5DigitYears:
-            yearString = "%05d" % abs(yearNum)
+    This lets loops over many dates work with plain integers rather than
+    building an LVDate for each one.
+
+    months -- the date, as an LVDate or a plain integer
+    spaceBeforeBC -- should there be a space between the number and the BC?
+       defaults to False
+    periods -- should BC have periods after the letters?
+       defaults to False
+    resolutionInYears -- should we print this as years only?
+       defaults to the value of dateResolutionDefaultsToYears
+    monthSeperator -- string to use to separate years from months
+       defaults to "/"
+    """
+
+    yearNum = months/12
+
+    if abs(yearNum) == yearNum:
+        bc = ""
+        space = ""
+    else:
+        if periods:
+            bc = "B.C."
         else:
-            yearString = str(abs(yearNum))
+            bc = "BC"
 
-        if (resolutionInYears is None and dateResolutionDefaultsToYears) \
-               or resolutionInYears is True:
-            return yearString + space + bc
+        if spaceBeforeBC:
+            space = " "
         else:
-            return yearString + monthSeparator + str(self % 12 + 1) \
-                   + space + bc
+            space = ""
+
+    if alwaysPrint5DigitYears:
+        yearString = "%05d" % abs(yearNum)
+    else:
+        yearString = str(abs(yearNum))
+
+    if (resolutionInYears is None and dateResolutionDefaultsToYears) \
+           or resolutionInYears is True:
+        return yearString + space + bc
+    else:
+        return yearString + monthSeparator + str(months % 12 + 1) \
+               + space + bc
 
 
 class Background:
@@ -319,17 +774,22 @@ class Background:
         self.lightDividerColor = (0xdd, 0xdd, 0xdd)
         """(R,G,B) tuple of light divider color."""
         
-        self.__img = gd.image((width, height))
         return
-        
-    def generate(self, filename):
-        """Generate a background image suitable for a longview timeline."""
+
+    def __drawGrid(self, img, width, height):
+        """Draw the dividers and dashed bottom line into img.
+
+        img -- image to draw into, with nothing allocated yet
+        width, height -- size of img
+
+        Returns the (transparent) background color index.
+        """
 
         # draw vertical dividers
         def drawDividers(startPoint, colorTuple):
             """Draw vertical timeline dividers once per self.intervalSize."""
 
-            brush = gd.image((self.dividerWidth, 1))
+            brush = lvraster.backend.image((self.dividerWidth, 1))
 
             # set up the colors
             backgroundColorIndex = brush.colorAllocate(self.backgroundColor)
@@ -339,51 +799,133 @@ class Background:
             # set up the pattern
             brush.setPixel((0,0), colorIndex)
             brush.setPixel((self.dividerWidth-1,0), colorIndex)
-            self.__img.setBrush(brush)
+            img.setBrush(brush)
 
             # draw the lines
             i = startPoint
-            while i <= self.width:
-                self.__img.line( (i,0), (i, self.height-1), gd.gdBrushed)
+            while i <= width:
+                img.line( (i,0), (i, height-1),
+                          lvraster.backend.gdBrushed)
                 i = i + self.intervalSize
 
         # setup
-        backgroundColorIndex = self.__img.colorAllocate(self.backgroundColor)
-        self.__img.colorTransparent(backgroundColorIndex)
-        lightDividerColorIndex = self.__img.colorAllocate(
-            self.lightDividerColor)
-        darkDividerColorIndex = self.__img.colorAllocate(self.darkDividerColor)
+        backgroundColorIndex = img.colorAllocate(self.backgroundColor)
+        img.colorTransparent(backgroundColorIndex)
+        lightDividerColorIndex = img.colorAllocate(self.lightDividerColor)
+        darkDividerColorIndex = img.colorAllocate(self.darkDividerColor)
 
         # draw the bottom line, dash-style
-        self.__img.setStyle((backgroundColorIndex, lightDividerColorIndex))
-        self.__img.line((0,self.height-1), (self.width,self.height-1),
-                        gd.gdStyled)
+        img.setStyle((backgroundColorIndex, lightDividerColorIndex))
+        img.line((0,height-1), (width,height-1),
+                 lvraster.backend.gdStyled)
 
         # draw the vertical dividers
         drawDividers(int(self.dividerWidth/2), self.lightDividerColor)
         drawDividers(int(self.intervalSize/2 + self.dividerWidth/2),
                      self.darkDividerColor)
 
-        # add now box
-        nowColorIndex = self.__img.colorAllocate(self.nowColor)
-        self.__img.filledRectangle( (self.nowStartXCoord, 0),
-                                    (self.nowStartXCoord + self.nowWidth-1, \
-                                     self.height-1), nowColorIndex )
+        return backgroundColorIndex
 
-        # draw the future stippling
-        stipple = gd.image((2,2))
+    def __drawStipple(self, img, startXCoord, endXCoord, height):
+        """Stipple the future section of img.
+
+        img -- image to draw into
+        startXCoord, endXCoord -- first and last X coordinates to stipple
+        height -- height of img
+        """
+
+        stipple = lvraster.backend.image((2,2))
         stippleBgColorIndex = stipple.colorAllocate(self.backgroundColor)
         stippleColorIndex = stipple.colorAllocate(self.stippleColor)
         stipple.colorTransparent(stippleBgColorIndex)
         stipple.setPixel((1,0), stippleColorIndex)
 
-        self.__img.setTile(stipple)
-        self.__img.filledRectangle((self.nowStartXCoord + self.nowWidth, 0),
-                                   (self.width-1, self.height-1), gd.gdTiled)
+        img.setTile(stipple)
+        img.filledRectangle((startXCoord, 0), (endXCoord, height-1),
+                            lvraster.backend.gdTiled)
+        return
+
+    def __write(self, img, filename):
+        """Write img out to filename as a PNG."""
+
+        file = open(filename, "w")
+        img.writePng(file)
+        file.close()
+        return
+
+    def getTileWidth(self):
+        """Return the width of one repeat of the dividers and bottom line."""
+
+        # the dashes of the bottom line alternate every pixel
+        if self.intervalSize % 2:
+            return self.intervalSize * 2
+        return self.intervalSize
+
+    def generate(self, filename):
+        """Generate a background image suitable for a longview timeline.
+
+        Every row but the last is the same as either the first or the
+        second one, depending on which way the future stippling alternates,
+        so only those and the last row are drawn, and they're repeated as
+        the PNG is written out.
+        """
+
+        if self.height > 4:
+            # the last row has to alternate the same way as the real one
+            drawnHeight = 4 - self.height % 2
+            rows = [y % 2 for y in range(self.height - 1)] + [drawnHeight - 1]
+        else:
+            drawnHeight = self.height
+            rows = range(self.height)
+
+        img = lvraster.backend.image((self.width, drawnHeight))
+        backgroundColorIndex = self.__drawGrid(img, self.width, drawnHeight)
+
+        # add now box
+        nowColorIndex = img.colorAllocate(self.nowColor)
+        img.filledRectangle( (self.nowStartXCoord, 0),
+                             (self.nowStartXCoord + self.nowWidth-1, \
+                              drawnHeight-1), nowColorIndex )
+
+        # draw the future stippling
+        self.__drawStipple(img, self.nowStartXCoord + self.nowWidth,
+                           self.width-1, drawnHeight)
 
-        # write out the file
         file = open(filename, "w")
-        self.__img.writePng(file)
+        lvraster.writeRows(img, file, rows, backgroundColorIndex)
         file.close()
 
         return
+
+    def generateTile(self, filename):
+        """Generate one repeating tile of the background.
+
+        The tile has no now box or future stippling; those are left to the
+        page to draw on top of it (see generateFutureTile()).
+        """
+
+        img = lvraster.backend.image((self.getTileWidth(), self.height))
+        self.__drawGrid(img, self.getTileWidth(), self.height)
+        self.__write(img, filename)
+        return
+
+    def generateFutureTile(self, filename):
+        """Generate a tile that repeats to stipple the future section.
+
+        The tile is meant to be repeated starting at the first pixel after
+        the now box, so the stippling lines up with generate()'s.
+        """
+
+        img = lvraster.backend.image((2, self.height))
+        backgroundColorIndex = img.colorAllocate(self.backgroundColor)
+        stippleColorIndex = img.colorAllocate(self.stippleColor)
+        img.colorTransparent(backgroundColorIndex)
+
+        # generate() stipples every other pixel of every other line,
+        # counting from X coordinate 0 of the whole background
+        x = (1 + self.nowStartXCoord + self.nowWidth) % 2
+        for y in range(0, self.height, 2):
+            img.setPixel((x, y), stippleColorIndex)
+
+        self.__write(img, filename)
+        return
@@ -31,7 +31,77 @@ function captureMousePosition(e) {
   } 
 }
 
+// When longview.py is run with --lazy-popups, timeline.html doesn't contain
+// the popups.  Instead it defines popupTemplates and popupShards, and the
+// popups are loaded from popups/<shard>.js the first time one of them is
+// shown.
+
+popupValues = {};
+popupShardsLoading = {};
+hoveredNode = null;
+
+function loadPopups(popups) {
+  for (var id in popups) {
+    popupValues[id] = popups[id];
+  }
+  if (hoveredNode != null && popupValues[hoveredNode]) {
+    showNode(hoveredNode);
+  }
+}
+
+function createPopup(id) {
+  var values = popupValues[id];
+  var segments = popupTemplates[values[0]];
+  var html = segments[0];
+  for (var i = 1; i < segments.length; i += 2) {
+    var key = segments[i];
+    var index;
+    if (key == 'd') {
+      index = 1;
+    } else if (key == 'n') {
+      index = 2;
+    } else if (key == 't') {
+      index = 3;
+    } else {
+      index = 3 + parseInt(key);
+    }
+    html += (index < values.length ? values[index] : '%' + key) + segments[i + 1];
+  }
+
+  var holder = document.createElement('div');
+  holder.innerHTML = html;
+  while (holder.firstChild) {
+    document.body.appendChild(holder.firstChild);
+  }
+}
+
+function findPopup(id) {
+  var node = document.getElementById('node' + id);
+  if (node || typeof popupShards == 'undefined' || !(id in popupShards)) {
+    return node;
+  }
+
+  if (popupValues[id]) {
+    createPopup(id);
+    return document.getElementById('node' + id);
+  }
+
+  // show it once its shard has loaded
+  hoveredNode = id;
+  var shard = popupShards[id];
+  if (!popupShardsLoading[shard]) {
+    popupShardsLoading[shard] = true;
+    var script = document.createElement('script');
+    script.src = 'popups/' + shard + '.js';
+    document.getElementsByTagName('head')[0].appendChild(script);
+  }
+  return null;
+}
+
 function showNode(id) {
+  if (!findPopup(id)) {
+    return true;
+  }
   document.getElementById('node' + id).style.top = ySize + 'px';
   document.getElementById('node' + id).style.left = xSize + 'px';
   document.getElementById('node' + id).style.visibility = 'visible';
@@ -39,10 +109,113 @@ function showNode(id) {
 }
 
 function hideNode(id) {
+  hoveredNode = null;
+  if (!document.getElementById('node' + id)) {
+    return true;
+  }
   document.getElementById('node' + id).style.visibility = 'hidden';
   return true;
 }
 
+// When longview.py is run with --virtual-rows, the rows of the timeline
+// aren't in timeline.html.  rows.js calls loadRows() with the height of a
+// row and each row's bar position, bar width, bar HTML and label HTML, and
+// only the rows (and, of those, the bars) in view are put into the page.
+
+virtualRows = null;
+virtualRowHeight = 0;
+virtualBars = {};
+virtualLabels = {};
+
+// rows beyond the edges of the window to keep in the page, so that
+// scrolling a little doesn't leave gaps
+virtualRowMargin = 20;
+
+function loadRows(rowHeight, rows) {
+  virtualRowHeight = rowHeight;
+  virtualRows = rows;
+  window.onscroll = renderRows;
+  window.onresize = renderRows;
+  renderRows();
+}
+
+function getPageOffset(element) {
+  var left = 0;
+  var top = 0;
+  while (element) {
+    left += element.offsetLeft;
+    top += element.offsetTop;
+    element = element.offsetParent;
+  }
+  return [left, top];
+}
+
+function createRowElement(parent, row, html, className) {
+  var element = document.createElement('div');
+  if (className) {
+    element.className = className;
+  }
+  element.style.position = 'absolute';
+  element.style.left = '0px';
+  element.style.top = (row * virtualRowHeight) + 'px';
+  element.innerHTML = html;
+  parent.appendChild(element);
+  return element;
+}
+
+function renderRows() {
+  var table = document.getElementById('datatable');
+  var labels = document.getElementById('virtuallabels');
+  var offset = getPageOffset(table);
+
+  var scrollLeft, scrollTop, width, height;
+  if (window.innerWidth) {
+    scrollLeft = window.pageXOffset;
+    scrollTop = window.pageYOffset;
+    width = window.innerWidth;
+    height = window.innerHeight;
+  } else {
+    scrollLeft = document.documentElement.scrollLeft || document.body.scrollLeft;
+    scrollTop = document.documentElement.scrollTop || document.body.scrollTop;
+    width = document.documentElement.clientWidth || document.body.clientWidth;
+    height = document.documentElement.clientHeight || document.body.clientHeight;
+  }
+
+  var first = Math.max(0,
+    Math.floor((scrollTop - offset[1]) / virtualRowHeight) - virtualRowMargin);
+  var last = Math.min(virtualRows.length - 1,
+    Math.floor((scrollTop + height - offset[1]) / virtualRowHeight)
+    + virtualRowMargin);
+  var left = scrollLeft - offset[0] - width;
+  var right = scrollLeft - offset[0] + 2 * width;
+
+  var bars = {};
+  var rowLabels = {};
+  for (var i = first; i <= last; i++) {
+    var row = virtualRows[i];
+    rowLabels[i] = virtualLabels[i] || createRowElement(labels, i,
+      '<table class="labelstable" cellpadding="0" cellspacing="0" border="0">' +
+      row[3] + '</table>');
+    if (row[0] + row[1] >= left && row[0] <= right) {
+      bars[i] = virtualBars[i] || createRowElement(table, i, row[2], 'data');
+    }
+  }
+
+  // take out whatever has gone out of view
+  for (var i in virtualBars) {
+    if (!bars[i]) {
+      table.removeChild(virtualBars[i]);
+    }
+  }
+  for (var i in virtualLabels) {
+    if (!rowLabels[i]) {
+      labels.removeChild(virtualLabels[i]);
+    }
+  }
+  virtualBars = bars;
+  virtualLabels = rowLabels;
+}
+
 var menu;
 var theTop = 50;
 var old = theTop;
@@ -61,7 +61,8 @@ setup(name="longview",
       author="The Long Now Foundation",
       author_email="oss+longview@longnow.org",
       url="http://longnow.org/",
-      py_modules=["lvhtml", "lvutils", "lvnotify", "sliceMaker"],
+      py_modules=["lvhtml", "lvutils", "lvnotify", "lvpng", "lvraster",
+                  "sliceMaker"],
       scripts=["longview.py"],
       data_files=[("longview/examples",
                    glob.glob("biotech-*") + glob.glob("bets-*"))] + protoFiles)
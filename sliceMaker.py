@@ -32,7 +32,7 @@ import string
 import math
 import csv
 
-import gd
+import lvraster
 
 __author__ = "John Tangney and Dan Mosedale"
 __maintainer__ = "Ben Keating"
@@ -44,12 +44,87 @@ __license__ = "BSD-style"
 __status__ = "Beta"
 
 
+paletteSize = 256
+"""Number of colors that fit in a palette image."""
+
+maxBrightnessLevels = 84
+"""Most levels slice brightness is quantized to in a SlicedImage drawn
+directly.  A slice takes three colors at each level, which leaves four
+palette entries for the image's other colors; an image with more falls back
+to the closest color (see SlicedImage.allocateColor()).  Images built from
+a SlicedImageSpec count the colors they use instead; see
+SlicedImageSpec.getBrightnessBudget()."""
+
+colorTable = {}
+"""Lookup table of colors adjusted for saturation and brightness.  Maps a
+(base color, saturation, number of levels) tuple to a list holding the
+adjusted color for each of the levels from getBrightnessLevels()."""
+
+
+def getBrightnessLevels(saturation, maxLevels=maxBrightnessLevels):
+    """Return the number of levels brightness is quantized to.
+
+    saturation -- 0.0 to 1.0, as for getAdjustedColor()
+    maxLevels -- most levels to use
+
+    Brightness moves each component over 255 * (1 - saturation) units, so
+    with this many levels quantizing it shifts a component by at most one
+    unit.  If the levels are capped at maxLevels, the shift can grow to
+    255 * (1 - saturation) / (2 * (maxLevels - 1)) units; for the default
+    of maxBrightnessLevels, that is below a saturation of about 0.35.
+    """
+
+    levels = int(math.ceil(255 * (1 - saturation) / 2)) + 1
+    return max(2, min(levels, maxLevels))
+
+
+def getAdjustedColor(rgb, saturation, brightness,
+                     maxLevels=maxBrightnessLevels):
+    """Return an (r, g, b) tuple of rgb adjusted for saturation and brightness.
+
+    rgb -- base color, as a sequence of integers
+    saturation -- 0.0 to 1.0; at 1.0 the base color is returned unchanged
+    brightness -- 0.0 to 1.0, quantized to one of getBrightnessLevels()
+    maxLevels -- most brightness levels to use (see getBrightnessLevels())
+    """
+
+    brightnessLevels = getBrightnessLevels(saturation, maxLevels)
+    key = (tuple(rgb), saturation, brightnessLevels)
+
+    if not colorTable.has_key(key):
+        levels = []
+        for level in range(brightnessLevels):
+            levelBrightness = level / (brightnessLevels - 1)
+            levels.append(tuple(
+                [int(round(component * saturation + levelBrightness * 255.0
+                           * (1 - saturation))) for component in rgb]))
+        colorTable[key] = levels
+
+    level = int(round(min(max(brightness, 0.0), 1.0) * (brightnessLevels - 1)))
+    return colorTable[key][level]
+
+
 class SlicedImage:
     
-    def __init__(self, width, height):
-        self.__image = gd.image((width, height))
+    def __init__(self, width, height, image=None):
+        """Initialize a SlicedImage object
+
+        width, height -- size of the image
+        image -- image to draw into, such as an lvraster.svgImage; by
+                 default a new one is created with the raster backend
+        """
+
+        if image is None:
+            image = lvraster.backend.image((width, height))
+        self.__image = image
         self.__xOffset = 0
         self.__height = height
+
+        # palette index of every color allocated so far, keyed by color
+        self.__colorIndexes = {}
+
+        # [width, appearance] of the slice waiting to be drawn; see addSlice()
+        self.__pendingSlice = None
         
         self.diamondWidth = 7
         """Width of any diamonds rendered."""
@@ -62,23 +137,36 @@ class SlicedImage:
         
         self.diamondColor = (0xff, 0xff, 0xff)
         """Color used to render diamonds."""
+
+        self.maxBrightnessLevels = maxBrightnessLevels
+        """Most levels slice brightness is quantized to."""
         
         return
     
+    def allocateColor(self, rgb):
+        """Return the palette index for rgb, allocating it if necessary.
+
+        If the palette is already full, the closest existing color is used.
+        """
+
+        rgb = tuple(rgb)
+
+        if not self.__colorIndexes.has_key(rgb):
+            colorIndex = self.__image.colorAllocate(rgb)
+            if colorIndex == -1:
+                colorIndex = self.__image.colorClosest(rgb)
+            self.__colorIndexes[rgb] = colorIndex
+
+        return self.__colorIndexes[rgb]
+
     def addSlice(self, fields):
-        """Add a slice to this image"""
-        
-        # Returns a tuple of adjusted r, g, b integers given tuple of integers.
-        def computeRgbValues(rgb, saturation, brightness):
-            return map((lambda x:
-                        adjustColorComponent(x, saturation, brightness)), rgb)
-        
-        # Returns an integer value for the given component, adjusted for
-        # brightness and saturation.
-        def adjustColorComponent(component, saturation, brightness):
-            answer = component * saturation + brightness * 255.0 * \
-                     (1 - saturation)
-            return int(round(answer))
+        """Add a slice to this image
+
+        Drawing is put off until the next slice that looks different comes
+        along (or something else is drawn), so that a run of adjacent
+        slices that look identical, such as the months of a bar without any
+        interest data, is drawn as a single wider slice.
+        """
         
         width = fields["width"]
         height = fields["height"]
@@ -87,23 +175,53 @@ class SlicedImage:
         brightness = fields["brightness"]
         
         upperHeight = int(round(height - (height * fields["lowerSize"])))
+
+        maxLevels = self.maxBrightnessLevels
+
+        appearance = (
+            height, upperHeight,
+            getAdjustedColor(fields["lowerColor"], saturation, brightness,
+                             maxLevels),
+            getAdjustedColor(fields["dividerColor"], saturation, brightness,
+                             maxLevels),
+            getAdjustedColor(fields["upperColor"], saturation, brightness,
+                             maxLevels))
+
+        # a slice with a negative width is drawn differently from the
+        # equivalent part of a merged slice, so never merge those
+        if self.__pendingSlice is not None and width >= 0 \
+               and self.__pendingSlice[0] >= 0 \
+               and self.__pendingSlice[1] == appearance:
+            self.__pendingSlice[0] += width
+        else:
+            self.__drawPendingSlice()
+            self.__pendingSlice = [width, appearance]
+        
+        return
+
+    def __drawPendingSlice(self):
+        """Draw the slice waiting to be drawn, if there is one."""
+
+        if self.__pendingSlice is None:
+            return
+
+        width, (height, upperHeight, lowerRgb, dividerRgb, upperRgb) = \
+               self.__pendingSlice
+        self.__pendingSlice = None
         
         tl = (self.__xOffset, upperHeight + 1)
         br = (self.__xOffset + width, height)
-        lowerColor = self.__image.colorAllocate(
-            computeRgbValues(fields["lowerColor"],  saturation, brightness))
+        lowerColor = self.allocateColor(lowerRgb)
         self.__image.filledRectangle(tl, br, lowerColor)
         
         tl = (self.__xOffset, upperHeight)
         br = (self.__xOffset + width, upperHeight + 1)
-        dividerColor = self.__image.colorAllocate(
-            computeRgbValues(fields["dividerColor"], saturation, brightness))
+        dividerColor = self.allocateColor(dividerRgb)
         self.__image.filledRectangle(tl, br, dividerColor)
         
         tl = (self.__xOffset, 0)
         br = (self.__xOffset + width, upperHeight)
-        upperColor = self.__image.colorAllocate(
-            computeRgbValues(fields["upperColor"],  saturation, brightness))
+        upperColor = self.allocateColor(upperRgb)
         self.__image.filledRectangle(tl, br, upperColor)
         
         self.__xOffset += width
@@ -112,11 +230,10 @@ class SlicedImage:
     
     def drawDiamond(self, startX):
         """Draw a diamond whose leftmost point is at startX."""
+
+        self.__drawPendingSlice()
         
-        # allocate diamond color, if we haven't already
-        if not hasattr(self, '__diamondColorIndex'):
-            self.__diamondColorIndex = self.__image.colorAllocate(
-                self.diamondColor)
+        diamondColorIndex = self.allocateColor(self.diamondColor)
         
         # calculate the points
         bottomPoint = (startX + int(math.ceil(self.diamondWidth/2)),
@@ -128,7 +245,7 @@ class SlicedImage:
         
         # draw the diamond
         diamond = (bottomPoint, rightPoint, topPoint, leftPoint)
-        self.__image.filledPolygon(diamond, self.__diamondColorIndex)
+        self.__image.filledPolygon(diamond, diamondColorIndex)
         
         return
 
@@ -140,16 +257,26 @@ class SlicedImage:
         width -- width in pixels
         color -- color tuple
         """
+
+        self.__drawPendingSlice()
         
-        colorIndex = self.__image.colorAllocate(color)
+        colorIndex = self.allocateColor(color)
         self.__image.filledRectangle( (startX, 0),
                                       (startX + width - 1, self.__height),
                                       colorIndex )
         return
     
     
+    def getImage(self):
+        """Finish drawing, and return the image drawn into."""
+
+        self.__drawPendingSlice()
+        return self.__image
+
     def generate(self, filename):
         """Write out a PNG file for this image"""
+
+        self.__drawPendingSlice()
         
         # write out the file
         file = open(filename, "w")
@@ -159,6 +286,149 @@ class SlicedImage:
         return
 
 
+class SlicedImageSpec:
+    """A description of a SlicedImage, to be drawn later.
+
+    Has the same drawing methods as SlicedImage, but they only record what
+    is to be drawn.  Specs can be pickled, so they can be drawn in another
+    process with renderSlicedImage().
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        # these defaults are the same as SlicedImage's
+        self.diamondWidth = 7
+        """Width of any diamonds rendered."""
+
+        self.diamondLeftMargin = 2
+        """Width of horizontal margin on the left side a diamond"""
+
+        self.diamondVerticalMargin = 0
+        """Height of vertical margin above and below a diamond"""
+
+        self.diamondColor = (0xff, 0xff, 0xff)
+        """Color used to render diamonds."""
+
+        self.operations = []
+        """List of (method name, arguments) tuples to call on a SlicedImage"""
+
+        return
+
+    def addSlice(self, fields):
+        """Add a slice to this image"""
+
+        self.operations.append(('addSlice', (dict(fields),)))
+        return
+
+    def drawDiamond(self, startX):
+        """Draw a diamond whose leftmost point is at startX."""
+
+        self.operations.append(('drawDiamond', (startX,)))
+        return
+
+    def drawFilledSlice(self, startX, width, color):
+        """Draw a filled slice (see SlicedImage.drawFilledSlice())"""
+
+        self.operations.append(('drawFilledSlice', (startX, width, color)))
+        return
+
+    def getBrightnessBudget(self):
+        """Return the most brightness levels the slices can be quantized to.
+
+        Every distinct color the image uses at full saturation, for diamonds
+        or for filled slices takes one palette entry, and the rest are split
+        evenly between the colors adjusted for brightness.  That keeps the
+        image within paletteSize colors, unless it uses so many that even
+        two levels don't fit.
+        """
+
+        otherColors = {}
+        adjustedColors = {}
+
+        for method, args in self.operations:
+            if method == 'addSlice':
+                fields = args[0]
+                for name in ('lowerColor', 'dividerColor', 'upperColor'):
+                    if fields['saturation'] >= 1.0:
+                        otherColors[tuple(fields[name])] = True
+                    else:
+                        adjustedColors[(tuple(fields[name]),
+                                        fields['saturation'])] = True
+            elif method == 'drawDiamond':
+                otherColors[tuple(self.diamondColor)] = True
+            elif method == 'drawFilledSlice':
+                otherColors[tuple(args[2])] = True
+
+        if len(adjustedColors) == 0:
+            return maxBrightnessLevels
+
+        return max(2, (paletteSize - len(otherColors)) // len(adjustedColors))
+
+    def getDescription(self):
+        """Return a string that is the same for any two identical specs."""
+
+        operations = []
+        for method, args in self.operations:
+            if method == 'addSlice':
+                fields = args[0].items()
+                fields.sort()
+                args = [(name, tuple(value) if type(value) is list else value)
+                        for name, value in fields]
+            operations.append((method, args))
+
+        return repr((self.width, self.height, self.diamondWidth,
+                     self.diamondLeftMargin, self.diamondVerticalMargin,
+                     tuple(self.diamondColor), self.getBrightnessBudget(),
+                     operations))
+
+
+def renderSlicedImage(spec, filename, cache=None):
+    """Draw the SlicedImage described by spec and write it to filename.
+
+    cache -- lvutils.ImageCache to reuse a previously drawn image from, and
+             store newly drawn images in, or None
+    """
+
+    if cache is not None:
+        description = spec.getDescription()
+        if cache.fetch(description, filename):
+            return
+
+    buildSlicedImage(spec).generate(filename)
+
+    if cache is not None:
+        cache.store(description, filename)
+    return
+
+
+def buildSlicedImage(spec, image=None):
+    """Return a SlicedImage with everything in spec drawn into it.
+
+    image -- image to draw into (see SlicedImage.__init__())
+    """
+
+    slicedImage = SlicedImage(spec.width, spec.height, image)
+    slicedImage.diamondWidth = spec.diamondWidth
+    slicedImage.diamondLeftMargin = spec.diamondLeftMargin
+    slicedImage.diamondVerticalMargin = spec.diamondVerticalMargin
+    slicedImage.diamondColor = spec.diamondColor
+    slicedImage.maxBrightnessLevels = spec.getBrightnessBudget()
+
+    for method, args in spec.operations:
+        getattr(slicedImage, method)(*args)
+
+    return slicedImage
+
+
+def buildSvgImage(spec):
+    """Return an lvraster.svgImage of the SlicedImage described by spec."""
+
+    return buildSlicedImage(
+        spec, lvraster.svgImage((spec.width, spec.height))).getImage()
+
+
 # Returns a tuple of red, green, and blue integer values, given a hex string
 def parseHexColor(hex):
     justHex = hex.split('#')[-1]